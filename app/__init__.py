@@ -24,7 +24,22 @@ def create_app(config_name):
 	db.init_app(app)
 	login_manager.init_app(app)
 	mail.init_app(app)
-	Scss(app, static_dir='app/static/css', asset_dir='app/static/assets')
+
+	from .assets import Assets
+	assets = Assets(app)
+	if not assets.built:
+		# Without built assets SCSS is compiled on request
+		Scss(app, static_dir='app/static/css', asset_dir='app/static/assets')
+
+	from .compress import GzipMiddleware
+	app.wsgi_app = GzipMiddleware(
+		app.wsgi_app, app.config['RECORDBIN_GZIP_MIN_SIZE'], app.config['RECORDBIN_GZIP_LEVEL'])
+
+	from .presence import LastSeenBuffer
+	LastSeenBuffer(app)
+
+	# registers the search index's table and mapper events
+	from . import search
 
 	from main import main as main_blueprint
 	app.register_blueprint(main_blueprint)
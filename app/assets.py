@@ -0,0 +1,186 @@
+"""Precompiled, fingerprinted static bundles
+
+`manage.py assets build` compiles the SCSS once, concatenates and minifies
+the page scripts, and writes each bundle under a name carrying a hash of
+its content, next to a gzipped copy and a manifest.json mapping bundle
+names to files. A content change is a new URL, so the files are served
+with a one-year immutable Cache-Control and never revalidated.
+
+Templates ask for `asset_urls(bundle)`. With RECORDBIN_ASSETS_BUILT set,
+as it is in production, that is the built file, and a missing manifest
+stops the app from starting. Otherwise it is the bundle's source files
+under /static, with main.css kept fresh by Flask-Scss, whatever is left
+in the asset directory.
+"""
+import gzip
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from flask import abort, request, send_from_directory, url_for
+
+# Bundle name -> sources under the static folder, in load order
+BUNDLES = OrderedDict([
+	('main.css', ['assets/main.scss']),
+	('user.js', [
+		'js/collection.js', 'js/size_nav.js', 'js/edit_record.js', 'js/search.js',
+		'js/my_cloudinary.js'])
+])
+MANIFEST = 'manifest.json'
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# A "/" after one of these starts a regular expression, not a division
+_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+
+
+def minify_js(source):
+	"""Drop comments, indentation and blank lines from a script
+
+	Newlines are kept, so automatic semicolon insertion reads the result
+	the way it read the source. Strings, template literals and regular
+	expressions are copied through untouched.
+	"""
+	out = []
+	i, length = 0, len(source)
+	last = ''
+	while i < length:
+		char = source[i]
+		if source.startswith('//', i):
+			i = source.find('\n', i)
+			i = length if i < 0 else i
+			continue
+		if source.startswith('/*', i):
+			end = source.find('*/', i + 2)
+			end = length if end < 0 else end + 2
+			out.append('\n' if '\n' in source[i:end] else ' ')
+			i = end
+			continue
+		if char in '\'"`' or (char == '/' and (not last or last in _REGEX_PRECEDERS)):
+			start, i = i, i + 1
+			in_class = False
+			while i < length:
+				if source[i] == '\\':
+					i += 2
+					continue
+				if char == '/' and source[i] == '[':
+					in_class = True
+				elif char == '/' and source[i] == ']':
+					in_class = False
+				elif source[i] == char and not in_class:
+					break
+				elif source[i] == '\n' and char != '`':
+					break
+				i += 1
+			i += 1
+			out.append(source[start:i])
+			last = source[i - 1]
+			continue
+		out.append(char)
+		if not char.isspace():
+			last = char
+		i += 1
+
+	lines = (line.strip() for line in ''.join(out).splitlines())
+	return '\n'.join(line for line in lines if line) + '\n'
+
+
+def compile_scss(path):
+	from scss.compiler import Compiler
+	compiler = Compiler(search_path=[os.path.dirname(path)], output_style='compressed')
+	return compiler.compile(path)
+
+
+def _bundle(static_dir, name):
+	paths = [os.path.join(static_dir, source) for source in BUNDLES[name]]
+	if name.endswith('.css'):
+		return ''.join(compile_scss(path) for path in paths)
+	parts = []
+	for path in paths:
+		with open(path) as f:
+			parts.append(minify_js(f.read()))
+	# A script ending without a semicolon must not run into the next one
+	return ';\n'.join(parts)
+
+
+def build(static_dir, out_dir):
+	"""Write every bundle and its .gz into `out_dir`; returns the manifest
+
+	Files from earlier builds are left alone, so pages rendered before a
+	deploy keep working while they are still open.
+	"""
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+	manifest = OrderedDict()
+	for name in BUNDLES:
+		content = _bundle(static_dir, name)
+		if isinstance(content, unicode):
+			content = content.encode('utf-8')
+		stem, extension = os.path.splitext(name)
+		filename = '{}.{}{}'.format(stem, hashlib.sha1(content).hexdigest()[:12], extension)
+		path = os.path.join(out_dir, filename)
+		with open(path, 'wb') as f:
+			f.write(content)
+		# mtime=0 keeps rebuilds of the same content byte-identical
+		with open(path + '.gz', 'wb') as raw:
+			compressed = gzip.GzipFile(filename, 'wb', 9, raw, mtime=0)
+			compressed.write(content)
+			compressed.close()
+		manifest[name] = filename
+
+	# Written last, so a failed build leaves the previous manifest in place
+	with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+		json.dump(manifest, f, indent=2)
+	return manifest
+
+
+def _source_path(source):
+	"""Where Flask-Scss leaves the compiled CSS of an .scss source"""
+	if source.endswith('.scss'):
+		return 'css/' + os.path.basename(source)[:-len('.scss')] + '.css'
+	return source
+
+
+class Assets(object):
+
+	def __init__(self, app=None):
+		self.manifest = None
+		self.directory = None
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.directory = app.config['RECORDBIN_ASSET_DIR']
+		if app.config['RECORDBIN_ASSETS_BUILT']:
+			path = os.path.join(self.directory, MANIFEST)
+			if not os.path.exists(path):
+				raise RuntimeError(
+					'RECORDBIN_ASSETS_BUILT is set but {} is missing; '
+					'run `manage.py assets build`'.format(path))
+			with open(path) as f:
+				self.manifest = json.load(f)
+			app.add_url_rule('/assets/<path:filename>', 'assets', self.send)
+		app.extensions['assets'] = self
+		app.jinja_env.globals['asset_urls'] = self.urls
+
+	@property
+	def built(self):
+		return self.manifest is not None
+
+	def urls(self, name):
+		"""URLs to load bundle `name` from, in order"""
+		if self.built:
+			return [url_for('assets', filename=self.manifest[name])]
+		return [url_for('static', filename=_source_path(source)) for source in BUNDLES[name]]
+
+	def send(self, filename):
+		if filename == MANIFEST:
+			abort(404)
+		gzipped = 'gzip' in request.accept_encodings and \
+			os.path.exists(os.path.join(self.directory, filename + '.gz'))
+		response = send_from_directory(
+			self.directory, filename + '.gz' if gzipped else filename, cache_timeout=ONE_YEAR)
+		if gzipped:
+			response.headers['Content-Encoding'] = 'gzip'
+		response.vary.add('Accept-Encoding')
+		response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(ONE_YEAR)
+		return response
@@ -1,7 +1,7 @@
 from flask import render_template, redirect, request, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from . import auth
-from .. import db
+from .. import db, presence
 from ..models import User
 from .forms import (
 	LoginForm, RegistrationForm, ChangePasswordForm,
@@ -91,7 +91,7 @@ def resend_confirmation():
 @auth.before_app_request
 def before_request():
 	if current_user.is_authenticated:
-		current_user.ping()
+		presence.touch(current_user.id)
 		if not current_user.confirmed \
 			and request.endpoint[:5] != 'auth.' \
 			and request.endpoint != 'static':
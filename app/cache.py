@@ -0,0 +1,43 @@
+"""Small in-process caches shared by the models and views"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+	"""A thread-safe LRU mapping whose entries also expire after `ttl` seconds"""
+
+	def __init__(self, maxsize=1024, ttl=60):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._data = OrderedDict()
+
+	def get(self, key, default=None):
+		with self._lock:
+			entry = self._data.pop(key, None)
+			if entry is None:
+				return default
+			expires, value = entry
+			if expires < time.time():
+				return default
+			self._data[key] = entry
+			return value
+
+	def set(self, key, value):
+		with self._lock:
+			self._data.pop(key, None)
+			self._data[key] = (time.time() + self.ttl, value)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def __len__(self):
+		return len(self._data)
@@ -0,0 +1,123 @@
+"""gzip for responses, applied around the WSGI app
+
+Bodies are compressed as they stream: each chunk the app yields goes
+through one zlib stream and is sync-flushed, so a streamed download or
+import progress reaches the client as it is produced rather than once
+the response ends. Responses that are already encoded, not a text-like
+type, or with a Content-Length under the minimum size go out untouched.
+Streamed bodies have no length to check and are compressed as they come,
+except event streams, whose small keepalives gzip cannot help.
+
+The gzip body is a different representation from the identity one, so
+its ETag gets a "-gzip" suffix. The suffix is taken off If-None-Match
+before the app compares its validators, and put back on the 304.
+"""
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_set_header, dump_header
+
+COMPRESSIBLE_TYPES = (
+	'text/', 'application/json', 'application/x-ndjson', 'application/javascript',
+	'application/xml', 'image/svg+xml')
+GZIP_SUFFIX = '-gzip'
+
+
+def _accepts_gzip(environ):
+	accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+	return accept.quality('gzip') > 0
+
+
+def _compressible(status, headers):
+	if not status.startswith('200') or 'Content-Encoding' in headers:
+		return False
+	if 'no-transform' in headers.get('Cache-Control', ''):
+		return False
+	content_type = headers.get('Content-Type', '')
+	return content_type.startswith(COMPRESSIBLE_TYPES) and \
+		not content_type.startswith('text/event-stream')
+
+
+def _strip_gzip_etags(environ):
+	"""`environ` with our suffix taken off the If-None-Match tags, and whether any had it"""
+	header = environ.get('HTTP_IF_NONE_MATCH')
+	if not header or GZIP_SUFFIX + '"' not in header:
+		return environ, False
+	return dict(environ, HTTP_IF_NONE_MATCH=header.replace(GZIP_SUFFIX + '"', '"')), True
+
+
+def _mark_gzip(headers, etag=True):
+	vary = parse_set_header(headers.get('Vary'))
+	vary.add('Accept-Encoding')
+	headers['Vary'] = dump_header(vary)
+	tag = headers.get('ETag')
+	if etag and tag and tag.endswith('"') and not tag.endswith(GZIP_SUFFIX + '"'):
+		headers['ETag'] = tag[:-1] + GZIP_SUFFIX + '"'
+
+
+class GzipMiddleware(object):
+
+	def __init__(self, app, min_size=1024, level=6):
+		self.app = app
+		self.min_size = min_size
+		self.level = level
+
+	def __call__(self, environ, start_response):
+		if self.level <= 0 or environ['REQUEST_METHOD'] == 'HEAD' or not _accepts_gzip(environ):
+			return self.app(environ, start_response)
+
+		environ, gzip_tagged = _strip_gzip_etags(environ)
+		response = []
+		written = []
+		sent = []
+
+		def capture(status, headers, exc_info=None):
+			if exc_info is not None and sent:
+				raise exc_info[0], exc_info[1], exc_info[2]
+			response[:] = [status, Headers(headers)]
+			return written.append
+
+		def send(status, headers):
+			sent.append(True)
+			return start_response(status, headers.to_wsgi_list())
+
+		body = self.app(environ, capture)
+		return self._respond(body, written, response, send, gzip_tagged)
+
+	def _respond(self, body, written, response, start_response, gzip_tagged):
+		try:
+			chunks = iter(body)
+			# The app has called start_response once its iterable starts yielding
+			pending = list(written)
+			if not response:
+				pending.append(next(chunks, ''))
+			status, headers = response
+
+			if status.startswith('304'):
+				# Not modified: the client's copy is gzip if the tag it sent was
+				_mark_gzip(headers, etag=gzip_tagged)
+			length = headers.get('Content-Length', type=int)
+			if not _compressible(status, headers) or (length is not None and length < self.min_size):
+				start_response(status, headers)
+				# At least one item, even for an empty 304, so start_response is seen
+				for chunk in pending or ['']:
+					yield chunk
+				for chunk in chunks:
+					yield chunk
+				return
+
+			headers.pop('Content-Length', None)
+			headers['Content-Encoding'] = 'gzip'
+			_mark_gzip(headers)
+			start_response(status, headers)
+
+			compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			data = compressor.compress(''.join(pending))
+			for chunk in chunks:
+				data += compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+				if data:
+					yield data
+					data = ''
+			yield data + compressor.flush()
+		finally:
+			if hasattr(body, 'close'):
+				body.close()
@@ -0,0 +1,73 @@
+"""Conditional GETs for pages built from version stamps
+
+A page's ETag is a hash of the cheap values it is rendered from (a
+user's collection_version and counters, a Stamp) plus who is looking at
+it, so a revalidation costs those reads and nothing else: a match is
+answered with 304 before any list query or template runs.
+
+Last-Modified is only sent to anonymous viewers. A browser keeps one copy
+of a page across logging in and out, and If-Modified-Since alone cannot
+tell those copies apart; the ETag can, because it carries the viewer.
+"""
+import hashlib
+import time
+from flask import current_app, request, session
+from flask_login import current_user
+
+# Owner pages carry CSRF tokens, so their ETags change once per half
+# token lifetime and a revalidated page still has a usable token
+CSRF_BUCKETS_PER_LIMIT = 2
+
+
+def _asset_files():
+	# Pages name fingerprinted bundles, so a new build must change their ETags
+	assets = current_app.extensions.get('assets')
+	if assets is None or not assets.built:
+		return None
+	return sorted(assets.manifest.values())
+
+
+class Validators(object):
+
+	def __init__(self, etag, last_modified=None):
+		self.etag = etag
+		self.last_modified = last_modified
+
+	def not_modified(self):
+		"""A 304 response if the request's validators match, else None"""
+		response = current_app.response_class()
+		self.apply(response)
+		response.make_conditional(request)
+		if response.status_code == 304:
+			return response
+		return None
+
+	def apply(self, response):
+		response.set_etag(self.etag)
+		if self.last_modified is not None:
+			response.last_modified = self.last_modified
+		response.cache_control.no_cache = True
+		if current_user.is_authenticated:
+			response.cache_control.private = True
+		response.vary.add('Cookie')
+		return response
+
+
+def page_validators(page, stamp, last_modified=None, forms=False):
+	"""Validators for `page` rendered from `stamp`, or None if it can't be cached
+
+	`stamp` is any tuple of cheap values the page is built from. None is
+	returned for anything but GET/HEAD and while flashed messages are
+	waiting, since those show up once on whatever page comes next.
+	"""
+	if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+		return None
+	viewer = current_user.id if current_user.is_authenticated else 0
+	parts = [page, current_app.config['RECORDBIN_RELEASE'], _asset_files(), viewer] + list(stamp)
+	limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+	if forms and limit:
+		parts.append(int(time.time() * CSRF_BUCKETS_PER_LIMIT // limit))
+	etag = hashlib.sha1(repr(parts)).hexdigest()
+	if viewer:
+		last_modified = None
+	return Validators(etag, last_modified)
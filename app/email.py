@@ -1,20 +1,21 @@
-from threading import Thread
-from flask import current_app, render_template
-from flask_mail import Message
-from . import mail
+"""Account mail, rendered in the request and sent through the outbox
 
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+The confirmation, password reset and email change messages link back to
+the site, which url_for can only build inside a request. send_email
+renders them there and queues the result with queue_email, so they are
+as durable as every other message: `manage.py send_outbox` delivers
+them, retrying failures, and a restarted web worker loses nothing.
+"""
+from flask import render_template
+from . import db
+from .outbox import queue_email
 
 
 def send_email(to, subject, template, **kwargs):
-    app = current_app._get_current_object()
-    msg = Message(app.config['RECORDBIN_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['RECORDBIN_MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    """Render `template` for `to` and commit it to the outbox"""
+    message = queue_email(
+        to, template.rsplit('/', 1)[-1], subject,
+        body=render_template(template + '.txt', **kwargs),
+        html=render_template(template + '.html', **kwargs))
+    db.session.commit()
+    return message
@@ -0,0 +1,171 @@
+"""Streaming exports of a user's collection
+
+Rows are read with column-only queries ordered in SQL and fetched in
+batches (`yield_per`, a server-side cursor where the driver has one), and
+written out a batch at a time, so an export of any size starts at once
+and holds one batch in memory.
+
+Three layouts are offered: the CSV `download` has always written, JSON
+Lines with every field of a record, and a .tar.gz archive holding the
+JSON Lines plus a manifest of image URLs.
+"""
+import csv
+import json
+import tarfile
+import time
+import zlib
+from tempfile import SpooledTemporaryFile
+from . import db
+from .models import Title, Artist, Size, Format, Image, encode_id
+
+CSV_COLUMNS = ["Artist", "Title", "Color", "Year", "Size", "Date Added"]
+DATE_FORMAT = '%m/%d/%y'
+BATCH_SIZE = 500
+# Archive members are spooled here before being streamed; past this they go to disk
+SPOOL_SIZE = 1024 * 1024
+
+
+class _Lines(object):
+	"""File-like sink for csv.writer that hands back what was written"""
+
+	def __init__(self):
+		self.parts = []
+
+	def write(self, data):
+		self.parts.append(data)
+
+	def take(self):
+		data = ''.join(self.parts)
+		self.parts = []
+		return data
+
+
+def _utf8(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+
+def iter_csv(user):
+	"""CSV of `user`'s collection in the download layout, in chunks"""
+	rows = db.session.query(
+		Artist.name, Title.name, Title.color, Title.year, Size.name, Title.timestamp) \
+		.join(Title, Title.artist_id == Artist.id) \
+		.join(Size, Title.size_id == Size.id) \
+		.filter(Title.owner_id == user.id) \
+		.order_by(Size.name, Artist.name, Title.year, Title.name, Title.id) \
+		.yield_per(BATCH_SIZE)
+
+	lines = _Lines()
+	writer = csv.writer(lines)
+	writer.writerow(CSV_COLUMNS)
+	for count, (artist, name, color, year, size, timestamp) in enumerate(rows, 1):
+		writer.writerow([
+			_utf8(artist), _utf8(name), _utf8(color), year, size,
+			timestamp.strftime(DATE_FORMAT) if timestamp else ''])
+		if count % BATCH_SIZE == 0:
+			yield lines.take()
+	yield lines.take()
+
+
+def gzip_chunks(chunks, level=6):
+	"""Compress an iterable of byte strings into one gzip stream"""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for chunk in chunks:
+		data = compressor.compress(chunk)
+		if data:
+			yield data
+	yield compressor.flush()
+
+
+def _records(user):
+	return db.session.query(
+		Title.id, Artist.name, Title.name, Title.color, Title.year, Title.notes,
+		Size.name, Format.name, Title.mail, Title.timestamp, Image.image_url) \
+		.join(Artist, Title.artist_id == Artist.id) \
+		.join(Size, Title.size_id == Size.id) \
+		.join(Format, Title.format_id == Format.id) \
+		.outerjoin(Image, Image.record_id == Title.id) \
+		.filter(Title.owner_id == user.id) \
+		.order_by(*Title.collection_order()) \
+		.yield_per(BATCH_SIZE)
+
+
+def iter_jsonl(user):
+	"""One JSON object per line for each record of `user`, in chunks"""
+	lines = []
+	for row in _records(user):
+		title_id, artist, name, color, year, notes, size, format, mail, timestamp, image = row
+		lines.append(json.dumps({
+			"id": encode_id(title_id),
+			"artist": artist,
+			"title": name,
+			"color": color,
+			"year": year,
+			"notes": notes,
+			"size": size,
+			"format": format,
+			"mail": bool(mail),
+			"added": timestamp.isoformat() if timestamp else None,
+			"image": image
+		}, sort_keys=True))
+		if len(lines) == BATCH_SIZE:
+			yield '\n'.join(lines) + '\n'
+			lines = []
+	if lines:
+		yield '\n'.join(lines) + '\n'
+
+
+def iter_image_manifest(user):
+	"""Tab-separated record id and image URL for each image of `user`'s records"""
+	rows = db.session.query(Title.id, Image.image_url) \
+		.join(Image, Image.record_id == Title.id) \
+		.filter(Title.owner_id == user.id) \
+		.order_by(Title.id) \
+		.yield_per(BATCH_SIZE)
+	lines = []
+	for title_id, image_url in rows:
+		lines.append('{}\t{}'.format(encode_id(title_id), _utf8(image_url)))
+		if len(lines) == BATCH_SIZE:
+			yield '\n'.join(lines) + '\n'
+			lines = []
+	if lines:
+		yield '\n'.join(lines) + '\n'
+
+
+def _tar_member(name, chunks):
+	"""Tar header and data blocks for one member built from `chunks`
+
+	A tar header needs the member's size, so the data is spooled first;
+	it stays in memory up to SPOOL_SIZE and moves to a temporary file past it.
+	"""
+	spool = SpooledTemporaryFile(SPOOL_SIZE)
+	for chunk in chunks:
+		spool.write(chunk)
+	size = spool.tell()
+	spool.seek(0)
+
+	info = tarfile.TarInfo(name)
+	info.size = size
+	info.mtime = int(time.time())
+	yield info.tobuf()
+	while True:
+		data = spool.read(64 * 1024)
+		if not data:
+			break
+		yield data
+	spool.close()
+	if size % tarfile.BLOCKSIZE:
+		yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+
+def iter_archive(user, level=6):
+	"""A .tar.gz of records.jsonl and images.tsv for `user`, in chunks"""
+	def members():
+		for chunk in _tar_member('records.jsonl', iter_jsonl(user)):
+			yield chunk
+		for chunk in _tar_member('images.tsv', iter_image_manifest(user)):
+			yield chunk
+		yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+	return gzip_chunks(members(), level)
@@ -0,0 +1,48 @@
+"""Cache of rendered page fragments
+
+Fragments are keyed by what they were rendered from, e.g. an owner's
+collection version, so a write never has to find and delete them: it
+moves the version on and the old entries age out of the cache.
+
+The default backend is a bounded in-process LRU. Set
+RECORDBIN_FRAGMENT_CACHE_BACKEND to the import path of a class with
+`get(key)` and `set(key, value)` (werkzeug.contrib.cache.RedisCache or
+MemcachedCache, say) to share fragments between workers; it is built
+with RECORDBIN_FRAGMENT_CACHE_OPTIONS as keyword arguments.
+"""
+from flask import current_app
+from werkzeug.utils import import_string
+from .cache import TTLCache
+
+
+class FragmentCache(object):
+
+	def __init__(self, app):
+		config = app.config
+		self.prefix = config['RECORDBIN_FRAGMENT_CACHE_PREFIX']
+		backend = config['RECORDBIN_FRAGMENT_CACHE_BACKEND']
+		if backend:
+			self.backend = import_string(backend)(**config['RECORDBIN_FRAGMENT_CACHE_OPTIONS'])
+		else:
+			self.backend = TTLCache(
+				config['RECORDBIN_FRAGMENT_CACHE_SIZE'], config['RECORDBIN_FRAGMENT_CACHE_TTL'])
+
+	def get(self, key):
+		return self.backend.get(self.prefix + key)
+
+	def set(self, key, html):
+		self.backend.set(self.prefix + key, html)
+
+
+def fragment_cache(app=None):
+	"""The fragment cache of `app`, the current app by default"""
+	app = app or current_app._get_current_object()
+	cache = app.extensions.get('fragments')
+	if cache is None:
+		cache = app.extensions['fragments'] = FragmentCache(app)
+	return cache
+
+
+def collection_key(user, viewer_is_owner):
+	"""Key of `user`'s rendered record tables as seen by the owner or others"""
+	return 'records:{}:{}:{}'.format(user.id, user.collection_version, int(viewer_is_owner))
@@ -0,0 +1,228 @@
+"""Bulk import of a collection from the CSV layout `download` writes
+
+The file is read one row at a time. Valid rows are buffered into chunks.
+Each chunk resolves its artists in one batch, drops titles the owner
+already has (by content key), inserts the rest with one executemany,
+indexes them for search in one more statement and commits, so a large
+file holds a transaction only for one chunk at a time. Imported titles
+are history rather than new activity, so they are not fanned out to
+followers' feeds.
+"""
+import csv
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError, DataError
+from . import db
+from .lookups import lookups
+from .models import User, Title, Artist
+from .search import index_titles_after
+from .exports import CSV_COLUMNS, DATE_FORMAT
+
+# Read as well when present, so richer exports can be re-imported
+OPTIONAL_COLUMNS = ["Notes", "Mail"]
+REQUIRED_COLUMNS = ["Artist", "Title", "Year", "Size"]
+# CSV column -> the String column it is stored in, whose length bounds it
+BOUNDED_COLUMNS = [
+	("Artist", Artist.__table__.c.name), ("Title", Title.__table__.c.name),
+	("Color", Title.__table__.c.color), ("Notes", Title.__table__.c.notes)]
+# Year is an INTEGER column
+_MAX_YEAR = 2 ** 31 - 1
+# Stay well under SQLite's bound parameter limit
+_LOOKUP_BATCH = 500
+
+ImportRow = namedtuple('ImportRow', [
+	'line', 'artist', 'name', 'color', 'year', 'size_id', 'notes', 'mail', 'timestamp'])
+
+
+class CollectionImportError(ValueError):
+	"""The file as a whole cannot be imported"""
+
+
+class ImportResult(object):
+	"""Running totals of an import; keeps at most `max_errors` row errors"""
+
+	def __init__(self, max_errors=100):
+		self.rows = 0
+		self.added = 0
+		self.duplicates = 0
+		self.errors = []
+		self.error_count = 0
+		self.max_errors = max_errors
+
+	def error(self, line, message):
+		self.error_count += 1
+		if self.max_errors is None or len(self.errors) < self.max_errors:
+			self.errors.append((line, message))
+
+	def to_json(self):
+		return {
+			"rows": self.rows,
+			"added": self.added,
+			"duplicates": self.duplicates,
+			"error_count": self.error_count,
+			"errors": [{"line": line, "error": message} for line, message in self.errors]
+		}
+
+
+def _cell(value):
+	return value.decode('utf-8').strip()
+
+
+def _parse_row(line, cells, columns, size_ids):
+	"""ImportRow for one CSV row; raises ValueError with a readable message"""
+	try:
+		values = dict((name, _cell(cells[index]) if index < len(cells) else u'')
+			for name, index in columns.items())
+	except UnicodeDecodeError:
+		raise ValueError('not valid UTF-8')
+
+	for name in ('Artist', 'Title'):
+		if not values[name]:
+			raise ValueError('{} is required'.format(name))
+	for name, column in BOUNDED_COLUMNS:
+		if len(values.get(name, u'')) > column.type.length:
+			raise ValueError('{} has a {} character limit'.format(name, column.type.length))
+
+	try:
+		year = int(values['Year']) if values['Year'] else None
+	except ValueError:
+		raise ValueError('Year must be a number')
+	if year is not None and abs(year) > _MAX_YEAR:
+		raise ValueError('Year is out of range')
+
+	try:
+		size_id = size_ids[int(values['Size'])]
+	except (ValueError, KeyError):
+		raise ValueError('unknown Size "{}"'.format(values['Size'].encode('utf-8')))
+
+	timestamp = None
+	if values.get('Date Added'):
+		try:
+			timestamp = datetime.strptime(values['Date Added'], DATE_FORMAT)
+		except ValueError:
+			raise ValueError('Date Added must look like 12/31/99')
+
+	mail = 1 if values.get('Mail', u'').lower() in (u'1', u'yes', u'true') else 0
+	return ImportRow(
+		line, values['Artist'], values['Title'], values.get('Color') or None, year,
+		size_id, values.get('Notes') or None, mail, timestamp)
+
+
+def _header(cells):
+	columns = {}
+	for index, cell in enumerate(cells):
+		name = cell.decode('utf-8-sig').strip().lower()
+		for known in CSV_COLUMNS + OPTIONAL_COLUMNS:
+			if name == known.lower():
+				columns[known] = index
+	missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+	if missing:
+		raise CollectionImportError('missing column(s): {}'.format(', '.join(missing)))
+	return columns
+
+
+def _insert_chunk(user_id, chunk, result):
+	artist_ids = Artist.resolve_many(set(row.artist for row in chunk))
+	keyed = []
+	for row in chunk:
+		key = Title.content_key_for(
+			artist_ids[row.artist], row.name, row.year, row.size_id,
+			row.color, row.notes, user_id)
+		keyed.append((key, row))
+
+	keys = [key for key, row in keyed]
+	existing = set()
+	for start in xrange(0, len(keys), _LOOKUP_BATCH):
+		existing.update(key for key, in db.session.query(Title.content_key)
+			.filter(Title.content_key.in_(keys[start:start + _LOOKUP_BATCH])))
+
+	titles = Title.__table__
+	# Every row needs the same keys in an executemany
+	default_timestamp = titles.c.timestamp.default.arg
+	values = []
+	for key, row in keyed:
+		if key in existing:
+			result.duplicates += 1
+			continue
+		existing.add(key)
+		values.append(dict(
+			name=row.name, artist_id=artist_ids[row.artist], year=row.year,
+			format_id=1, owner_id=user_id, mail=row.mail, size_id=row.size_id,
+			color=row.color, notes=row.notes, content_key=key,
+			timestamp=row.timestamp or default_timestamp))
+
+	added = len(values)
+	if values:
+		# A Core insert skips the mapper events: index and version the chunk here
+		last_id = db.session.query(db.func.max(Title.id)).scalar() or 0
+		db.session.execute(titles.insert(), values)
+		index_titles_after(user_id, last_id)
+		User.bump_counter(user_id, User.collection_version, 1)
+	User.bump_counter(user_id, User.records_count, added)
+	try:
+		db.session.commit()
+	except (IntegrityError, DataError):
+		# Only a concurrent add of the same title, or a value the checks
+		# above let through, gets here; skip the chunk
+		db.session.rollback()
+		for row in chunk:
+			result.error(row.line, 'conflicted with a concurrent change, not imported')
+		return
+	result.added += added
+
+
+def iter_import(user, fileobj, chunk_size=500, max_errors=100):
+	"""Import CSV rows from `fileobj` into `user`'s collection
+
+	A generator: yields the running ImportResult after every committed
+	chunk, the last one being the final result. Rows that cannot be parsed
+	are reported in the result and skipped; an unusable header raises
+	CollectionImportError before anything is written.
+	"""
+	result = ImportResult(max_errors)
+	reader = csv.reader(fileobj)
+	try:
+		columns = _header(next(reader))
+	except StopIteration:
+		raise CollectionImportError('the file is empty')
+	except csv.Error as e:
+		raise CollectionImportError(str(e))
+
+	size_ids = dict((size.name, size.id) for size in lookups().sizes)
+	user_id = user.id
+	chunk = []
+	while True:
+		try:
+			cells = next(reader)
+		except StopIteration:
+			break
+		except csv.Error as e:
+			result.error(reader.line_num, str(e))
+			continue
+		if not any(cell.strip() for cell in cells):
+			continue
+
+		result.rows += 1
+		try:
+			chunk.append(_parse_row(reader.line_num, cells, columns, size_ids))
+		except ValueError as e:
+			result.error(reader.line_num, str(e))
+			continue
+
+		if len(chunk) >= chunk_size:
+			_insert_chunk(user_id, chunk, result)
+			chunk = []
+			yield result
+
+	if chunk:
+		_insert_chunk(user_id, chunk, result)
+	yield result
+
+
+def import_collection(user, fileobj, chunk_size=500, progress=None, max_errors=100):
+	"""Run iter_import to the end, calling `progress(result)` per chunk"""
+	result = None
+	for result in iter_import(user, fileobj, chunk_size, max_errors):
+		if progress is not None:
+			progress(result)
+	return result
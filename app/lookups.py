@@ -0,0 +1,105 @@
+"""Per-worker registry of the small reference tables
+
+Sizes, formats and roles are written by `deploy` and almost never change
+afterwards, yet forms and profile pages used to query them on every
+request. The registry loads them once per app as plain tuples, together
+with the release year choices and the rendered <option> HTML of the
+selects built from them. Mapper events on Size, Format and Role
+invalidate it, so `insert_*` and admin edits are picked up on the next
+read; `reload()` forces a refresh.
+"""
+import threading
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+
+Lookup = namedtuple('Lookup', ['id', 'name'])
+RoleLookup = namedtuple('RoleLookup', ['id', 'name', 'permissions', 'default'])
+
+FIRST_YEAR = 1950
+
+
+class Lookups(object):
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._tables = None
+		self._years = None
+		self._options = {}
+
+	def _load(self):
+		from . import db
+		from .models import Size, Format, Role
+		return {
+			'sizes': [Lookup(*row) for row in
+				db.session.query(Size.id, Size.name).order_by(Size.id)],
+			'formats': [Lookup(*row) for row in
+				db.session.query(Format.id, Format.name).order_by(Format.id)],
+			'roles': [RoleLookup(*row) for row in
+				db.session.query(
+					Role.id, Role.name, Role.permissions, Role.default)
+				.order_by(Role.name)]}
+
+	def _table(self, name):
+		tables = self._tables
+		if tables is None:
+			tables = self._load()
+			with self._lock:
+				self._tables = tables
+		return tables[name]
+
+	def invalidate(self):
+		with self._lock:
+			self._tables = None
+			self._options = {}
+
+	def reload(self):
+		self.invalidate()
+		self._table('sizes')
+
+	@property
+	def sizes(self):
+		return self._table('sizes')
+
+	@property
+	def formats(self):
+		return self._table('formats')
+
+	@property
+	def roles(self):
+		return self._table('roles')
+
+	def role(self, name):
+		for role in self.roles:
+			if role.name == name:
+				return role
+
+	def size_choices(self):
+		return [(size.id, size.name) for size in self.sizes]
+
+	def role_choices(self):
+		return [(role.id, role.name) for role in self.roles]
+
+	def year_choices(self):
+		"""Release years, newest first; rebuilt only when the year turns"""
+		year = datetime.utcnow().year
+		if self._years is None or self._years[0] != year:
+			self._years = (year, [(value, value) for value in xrange(year, FIRST_YEAR - 1, -1)])
+		return self._years[1]
+
+	def options(self, choices, render):
+		"""Cached `render(choices)` output for a list of select choices"""
+		key = tuple(choices)
+		options = self._options.get(key)
+		if options is None:
+			options = self._options[key] = render(choices)
+		return options
+
+
+def lookups(app=None):
+	"""The registry for `app`, the current app by default"""
+	app = app or current_app._get_current_object()
+	registry = app.extensions.get('lookups')
+	if registry is None:
+		registry = app.extensions.setdefault('lookups', Lookups())
+	return registry
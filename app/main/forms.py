@@ -1,8 +1,30 @@
 from flask_wtf import Form
 from wtforms import StringField, SubmitField, BooleanField, TextAreaField, SelectField, HiddenField, FileField
 from wtforms.validators import Required, Email, Length, Regexp, ValidationError
-from ..models import Role, User, Format, Size
-import datetime
+from wtforms.widgets import Select, HTMLString, html_params
+from flask_wtf.file import FileField as UploadField, FileRequired
+from ..models import User
+from ..lookups import lookups
+
+
+class CachedSelect(Select):
+    """Select widget reusing the registry's rendered options for its choices"""
+
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('id', field.id)
+
+        def render(choices):
+            return [
+                (field.coerce(value),
+                 self.render_option(value, label, False),
+                 self.render_option(value, label, True))
+                for value, label in choices]
+
+        html = ['<select %s>' % html_params(name=field.name, **kwargs)]
+        for value, option, selected in lookups().options(field.choices, render):
+            html.append(selected if value == field.data else option)
+        html.append('</select>')
+        return HTMLString(''.join(html))
 
 
 class NameForm(Form):
@@ -39,7 +61,7 @@ class EditProfileAdminForm(Form):
 
     confirmed = BooleanField('Confirmed')
 
-    role = SelectField('Role', coerce=int)
+    role = SelectField('Role', coerce=int, widget=CachedSelect())
 
     name = StringField('Real Name', validators=[
         Length(0, 64)])
@@ -54,7 +76,7 @@ class EditProfileAdminForm(Form):
     def __init__(self, user, *args, **kwargs):
         """Autofill dropdown menus with choices"""
         super(EditProfileAdminForm, self).__init__(*args, **kwargs)
-        self.role.choices = [(role.id, role.name) for role in Role.query.order_by(Role.name).all()]
+        self.role.choices = lookups().role_choices()
         self.user = user
 
     def validate_email(self, field):
@@ -79,7 +101,7 @@ class AddRecordForm(Form):
         Required(message="Title is required"),
         Length(1, 63, message="Title field has a 64 character limit")])
 
-    year = SelectField("Year", coerce=int, validators=[
+    year = SelectField("Year", coerce=int, widget=CachedSelect(), validators=[
         Required()])
 
     # format = SelectField('Format', coerce=int)
@@ -90,7 +112,7 @@ class AddRecordForm(Form):
         Required(message="Please provide a color"),
         Length(1, 63, message="Color field has a 64 character limit")])
 
-    size = SelectField('Size', coerce=int)
+    size = SelectField('Size', coerce=int, widget=CachedSelect())
 
     incoming = BooleanField('Mail')
 
@@ -101,12 +123,10 @@ class AddRecordForm(Form):
         super(AddRecordForm, self).__init__(*args, **kwargs)
 
         # Record Sizes
-        self.size.choices = [(size.id, size.name) for size in Size.query.order_by(Size.id).all()]
+        self.size.choices = lookups().size_choices()
 
         # Release Years
-        years = list(xrange(1950, datetime.datetime.now().year + 1))
-        years.sort(reverse=True)
-        self.year.choices = [(value, value) for value in years]
+        self.year.choices = lookups().year_choices()
 
 
 class EditRecordForm(Form):
@@ -116,7 +136,7 @@ class EditRecordForm(Form):
 
     edit_title = StringField('Title*')
 
-    edit_year = SelectField("Year", coerce=int)
+    edit_year = SelectField("Year", coerce=int, widget=CachedSelect())
 
     # format = SelectField('Format', coerce=int)
 
@@ -124,7 +144,7 @@ class EditRecordForm(Form):
 
     edit_color = StringField('Color*')
 
-    edit_size = SelectField('Size', coerce=int)
+    edit_size = SelectField('Size', coerce=int, widget=CachedSelect())
 
     edit_incoming = BooleanField('Mail')
 
@@ -135,9 +155,14 @@ class EditRecordForm(Form):
         super(EditRecordForm, self).__init__(*args, **kwargs)
 
         # Record Sizes
-        self.edit_size.choices = [(size.id, size.name) for size in Size.query.order_by(Size.id).all()]
+        self.edit_size.choices = lookups().size_choices()
 
         # Release Years
-        years = list(xrange(1950, datetime.datetime.now().year + 1))
-        years.sort(reverse=True)
-        self.edit_year.choices = [(value, value) for value in years]
\ No newline at end of file
+        self.edit_year.choices = lookups().year_choices()
+
+
+class ImportCollectionForm(Form):
+    csv_file = UploadField('CSV file', validators=[
+        FileRequired(message="Choose a CSV file to import")])
+
+    submit = SubmitField('Import')
@@ -1,25 +1,44 @@
 from flask import (
 	render_template, redirect, url_for,
-	current_app, abort, flash, request, jsonify, make_response)
+	current_app, abort, flash, request, jsonify, make_response, json,
+	stream_with_context)
 from flask_login import login_required, current_user, login_user
 from .. import db
 from ..models import (
-	User, Role, Artist, Title,
-	Size, Format, gravatar, user_local_time, encode_id, decode_id, Image)
+	User, Artist, Title, Stamp, avatar_url, email_hash, user_local_time, encode_id, decode_id, Image,
+	group_records, record_cursor, parse_cursor, feed_cursor, parse_feed_cursor)
 from . import main
-from .forms import EditProfileForm, EditProfileAdminForm, AddRecordForm, EditRecordForm
+from .forms import (
+	EditProfileForm, EditProfileAdminForm, AddRecordForm, EditRecordForm,
+	ImportCollectionForm)
 from ..decorators import admin_required
 from datetime import datetime
 from ..auth.forms import LoginForm
 import urlparse
-from ..email import send_email
+import time
+from ..search import matching_ids, search_terms
+from ..notifications import hub
+from ..lookups import lookups
+from ..imports import iter_import, CollectionImportError
+from ..exports import iter_csv, iter_jsonl, iter_archive
+from ..fragments import fragment_cache, collection_key
+from ..conditional import page_validators
+from ..outbox import queue_email
+from jinja2 import Markup
+from sqlalchemy.exc import IntegrityError
 from string import Template
 
 
 @main.route('/users', methods=['GET', 'POST'])
 def all_users():
-	all_users = sorted(User.query.all(), key=lambda x: x.username.lower())
-	return render_template('users.html', all_users=all_users)
+	version, changed = Stamp.read('users')['users']
+	validators = page_validators('users', (version,), changed)
+	if validators is not None:
+		response = validators.not_modified()
+		if response is not None:
+			return response
+	all_users = User.query.order_by(db.func.lower(User.username)).all()
+	return with_validators(render_template('users.html', all_users=all_users), validators)
 
 @main.route('/about', methods=['GET', 'POST'])
 def about():
@@ -57,13 +76,26 @@ def index():
 @main.route('/<username>', methods=["GET", "POST"])
 def user(username):
 	user = User.query.filter_by(username=username).first_or_404()
+	viewer_is_owner = current_user.is_authenticated and user == current_user
+
+	# Follow changes move the counters, any record change the collection
+	# version, and the user's or a listed follower's details the profile
+	# version. None of them has a time, so there is no Last-Modified.
+	validators = page_validators('user', (
+		user.id, user.collection_version, user.records_count, user.followers_count,
+		user.followed_count, user.profile_version), forms=viewer_is_owner)
+	if validators is not None:
+		response = validators.not_modified()
+		if response is not None:
+			return response
+
 	followers = user.followers.all()
-	followers_count = user.followers.count()
+	followers_count = user.followers_count
 	followed = user.followed.all()
-	followed_count = user.followed.count()
+	followed_count = user.followed_count
 	now = datetime.utcnow
 
-	if current_user.is_authenticated and user == current_user:
+	if viewer_is_owner:
 		form = AddRecordForm()
 		edit_form = EditRecordForm()
 
@@ -79,31 +111,16 @@ def user(username):
 			mail = 1 if form.incoming.data else 0
 			add_image_url = form.add_image_url.data
 
-			a = Artist.query.filter_by(name=artist).first()
-			if a is None:
-				Artist(name=form.artist.data).add_to_table()
-				artist_id = Artist.query.filter_by(name=artist).first().id
-			else:
-				artist_id = a.id
-
-			# See if you already have this title
-			t = Title.query.filter_by(
-				name=title, artist_id=artist_id, year=year,
-				format_id=format_id, size_id=size_id, color=color,
-				notes=notes, owner_id=current_user.id).first()
+			artist_id = Artist.resolve(artist)
 
-			if t is None:
+			# The title's content key is unique, so a duplicate fails the insert
+			try:
 				Title(
 					name=title, artist_id=artist_id, year=year,
 					format_id=format_id, size_id=size_id, color=color,
-					notes=notes, owner_id=current_user.id, mail=mail).add_to_table()
-				record_id = Title.query.filter_by(name=title, artist_id=artist_id, year=year,
-					format_id=format_id, size_id=size_id, color=color,
-					notes=notes, owner_id=current_user.id, mail=mail).first().id
-				if add_image_url:
-					image = Image(record_id=record_id, image_url=add_image_url)
-					image.add_to_table()
-			else:
+					notes=notes, owner_id=current_user.id, mail=mail).add_to_table(add_image_url)
+			except IntegrityError:
+				db.session.rollback()
 				flash('You already own this', 'error')
 				return redirect(url_for('.user', username=current_user.username))
 			record_addition_success_msg = Template("$artist - $title Added!")
@@ -115,12 +132,11 @@ def user(username):
 
 		elif request.form.get('edit_id') and edit_form.validate_on_submit():
 
-			# decoded_id = decode_id(str(hashed_id))
-			# record = Title.query.filter_by(id=decoded_id).first_or_404()
+			# An invalid public id decodes to None and finds nothing
+			record_id = decode_id(edit_form.edit_id.data)
 
-			record_id = decode_id(str(edit_form.edit_id.data))
-
-			record = Title.query.filter_by(id=record_id).first_or_404()
+			record = Title.query.filter_by(
+				id=record_id, owner_id=current_user.id).first_or_404()
 
 			if record:
 
@@ -134,12 +150,7 @@ def user(username):
 				mail = 1 if edit_form.edit_incoming.data else 0
 				image_url = edit_form.image_url.data
 
-				a = Artist.query.filter_by(name=artist).first()
-				if a is None:
-					Artist(name=edit_form.edit_artist.data).add_to_table()
-					artist_id = Artist.query.filter_by(name=artist).first().id
-				else:
-					artist_id = a.id
+				artist_id = Artist.resolve(artist)
 
 				record.artist_id = artist_id
 				record.name = title
@@ -155,13 +166,17 @@ def user(username):
 
 				if i is None:
 					if image_url:
-						image = Image(record_id=record.id, image_url=image_url)
-						image.add_to_table()
+						db.session.add(Image(record_id=record.id, image_url=image_url))
 				else:
 					if image_url:
 						i.image_url = image_url
 
-				db.session.commit()
+				try:
+					db.session.commit()
+				except IntegrityError:
+					db.session.rollback()
+					flash('You already own this', 'error')
+					return redirect(url_for('.user', username=current_user.username))
 
 				record_update_success_msg = Template("$artist - $title Updated!")
 				flash(record_update_success_msg.substitute(
@@ -174,55 +189,192 @@ def user(username):
 		form = None
 		edit_form = None
 
-	if user != current_user:
-		user_records = Title.query.join(
-			Artist, Title.artist_id == Artist.id) \
-			.join(Size, Title.size_id == Size.id) \
-			.join(Format, Title.format_id == Format.id) \
-			.add_columns(Artist.name, Size.name, Format.name, Title.mail) \
-			.filter(Title.owner_id == user.id).all()
-	else:
-		user_records = current_user.owned_records()
+	sizes = lookups().sizes
+	fragments = fragment_cache()
+	key = collection_key(user, viewer_is_owner)
+	records_html = fragments.get(key)
+	if records_html is None:
+		records_html = render_records(user, viewer_is_owner)
+		fragments.set(key, records_html)
 
-	# Sort by artist name, then title year
-	user_records = sorted(user_records, key=lambda x: (x[1].lower(), x[0].year))
-	images = {x.record_id: x.image_url for x in Image.query.all()}
-	return render_template(
+	return with_validators(render_template(
 		'user.html',
 		form=form, edit_form=edit_form, user=user, followers=followers,
 		followers_count=followers_count, followed=followed, followed_count=followed_count,
-		seven_inches=[record for record in user_records if record[2] == 7 and record[4] == 0],
-		ten_inches=[record for record in user_records if record[2] == 10 and record[4] == 0],
-		twelve_inches=[record for record in user_records if record[2] == 12 and record[4] == 0],
-		seven_inches_mail=[record for record in user_records if record[2] == 7 and record[4] == 1],
-		ten_inches_mail=[record for record in user_records if record[2] == 10 and record[4] == 1],
-		twelve_inches_mail=[record for record in user_records if record[2] == 12 and record[4] == 1],
-		user_records_count=len(user_records),
-		encode_id=encode_id, now=now, images=images)
+		sizes=sizes, records_html=Markup(records_html),
+		user_records_count=user.records_count, encode_id=encode_id, now=now), validators)
+
+
+def with_validators(body, validators):
+	"""Response for `body` carrying `validators`, if the page has any"""
+	response = make_response(body)
+	if validators is not None:
+		validators.apply(response)
+	return response
+
+
+def render_records(user, viewer_is_owner):
+	"""HTML of the record tables on `user`'s profile"""
+	# Only the first page is rendered; the rest is fetched from user_records
+	# with the shared cursor, which is past every rendered row in every table
+	per_page = current_app.config['RECORDBIN_RECORDS_PER_PAGE']
+	first_page = user.records_page(limit=per_page)
+	cursor = record_cursor(first_page[-1]) if len(first_page) == per_page else None
+
+	registry = lookups()
+	record_groups = group_records(first_page, registry.sizes, registry.formats)
+	counts = user.record_group_counts()
+	group_totals = {
+		group.id: counts.get((group.size.name, group.format.name, group.mail), 0)
+		for group in record_groups}
+	images = {record[0].id: record[5] for record in first_page}
+	return render_template(
+		'include/_records.html',
+		user=user, viewer_is_owner=viewer_is_owner, record_groups=record_groups,
+		group_totals=group_totals, cursor=cursor, encode_id=encode_id, images=images)
+
+
+@main.route('/<username>/records')
+def user_records(username):
+	user = User.query.filter_by(username=username).first_or_404()
+	per_page = current_app.config['RECORDBIN_RECORDS_PER_PAGE']
+	limit = max(1, min(request.args.get('limit', per_page, type=int), per_page))
+
+	after = None
+	if request.args.get('after'):
+		after = parse_cursor(request.args['after'])
+		if after is None:
+			abort(400)
+
+	# ?q= narrows the collection to full-text index matches
+	title_ids = None
+	if search_terms(request.args.get('q')):
+		title_ids = matching_ids(user, request.args['q'])
+
+	records = user.records_page(
+		size_id=request.args.get('size', type=int),
+		format_id=request.args.get('format', type=int),
+		mail=request.args.get('mail', type=int),
+		after=after, limit=limit, title_ids=title_ids)
+
+	return jsonify(
+		records=[Title.collection_json(record, encode_id) for record in records],
+		next=record_cursor(records[-1]) if len(records) == limit else None)
 
 
 @main.route('/<username>/follower_records', methods=["GET", "POST"])
 @login_required
 def user_fr(username):
+	user = User.query.filter_by(username=username).first_or_404()
 
-	fr = User.query.filter_by(username=username).first_or_404().follower_records().limit(10).all()
-
-	# Sort by ID descending
-	fr.sort(key=lambda x: x[0].id, reverse=True)
+	# ?since= returns only items newer than the client's newest,
+	# ?before= pages back past its oldest
+	json_records = feed_json(
+		user, since=feed_cursor_arg(request.args.get('since')),
+		before=feed_cursor_arg(request.args.get('before')))
 
-	json_records = {}
+	# An unchanged feed is answered with a bodiless 304
+	response = current_app.response_class(
+		json.dumps(json_records), mimetype='application/json')
+	response.add_etag()
+	return response.make_conditional(request)
 
-	for i in range(len(fr)):
-		json_records[i] = {
-			"artist": fr[i][2],
-			"title": fr[i][0].name,
-			"user": "you" if fr[i][-1] == username else fr[i][-1],
-			"timestamp": fr[i][0].timestamp,
-			"gravatar": gravatar(fr[i][1]),
-			"id": fr[i][0].id
-		}
 
-	return jsonify(json_records)
+@main.route('/<username>/follower_records/stream')
+@login_required
+def user_fr_stream(username):
+	"""Server-Sent Events carrying new feed items as followed users add them"""
+	if not current_app.config['RECORDBIN_FEED_STREAMING']:
+		abort(404)
+	user = User.query.filter_by(username=username).first_or_404()
+	since = feed_cursor_arg(
+		request.headers.get('Last-Event-ID') or request.args.get('since'))
+	config = current_app.config
+
+	def events(since):
+		subscription = hub.subscribe(user.followed_ids())
+		# Don't pin a pooled connection while the stream idles
+		db.session.remove()
+		deadline = time.time() + config['RECORDBIN_FEED_STREAM_TIMEOUT']
+		pending = since is not None
+		try:
+			while time.time() < deadline:
+				if pending:
+					subscription.drain()
+					items = feed_json(user, since=since)
+					db.session.remove()
+					if items:
+						since = parse_feed_cursor(items[0]['cursor'])
+						yield 'id: {}\nevent: feed\ndata: {}\n\n'.format(
+							items[0]['cursor'], json.dumps(items))
+					# A full page may have more behind it
+					pending = len(items) == 10
+					continue
+				pending = subscription.get(config['RECORDBIN_FEED_KEEPALIVE']) is not None
+				if not pending:
+					yield ': keepalive\n\n'
+		finally:
+			subscription.close()
+
+	return current_app.response_class(
+		stream_with_context(events(since)), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@main.route('/<username>/follower_records/wait')
+@login_required
+def user_fr_wait(username):
+	"""Long-poll fallback: hold the request until there is something newer"""
+	if not current_app.config['RECORDBIN_FEED_STREAMING']:
+		abort(404)
+	user = User.query.filter_by(username=username).first_or_404()
+	since = feed_cursor_arg(request.args.get('since'))
+
+	# Subscribe before looking so nothing lands in between unseen
+	subscription = hub.subscribe(user.followed_ids())
+	try:
+		json_records = feed_json(user, since=since)
+		if not json_records:
+			db.session.remove()
+			if subscription.get(current_app.config['RECORDBIN_FEED_WAIT_TIMEOUT']) is not None:
+				json_records = feed_json(user, since=since)
+	finally:
+		subscription.close()
+
+	return current_app.response_class(
+		json.dumps(json_records), mimetype='application/json')
+
+
+def feed_cursor_arg(value):
+	"""Parse a since/before cursor from the request, rejecting bad ones"""
+	if not value:
+		return None
+	cursor = parse_feed_cursor(value)
+	if cursor is None:
+		abort(400)
+	return cursor
+
+
+def feed_json(user, since=None, before=None):
+	"""The next page of `user`'s feed as a newest-first list of dicts"""
+	fr = user.follower_records(since=since, before=before).limit(10).all()
+	if since is not None:
+		fr.reverse()
+
+	json_records = []
+
+	for record in fr:
+		json_records.append({
+			"artist": record[2],
+			"title": record[0].name,
+			"user": "you" if record[3] == user.username else record[3],
+			"timestamp": record[0].timestamp,
+			"gravatar": avatar_url(record[1]),
+			"id": record[0].id,
+			"cursor": feed_cursor(record)
+		})
+
+	return json_records
 
 
 @main.route('/edit-profile', methods=['GET', 'POST'])
@@ -251,10 +403,12 @@ def edit_profile_admin(id):
 	user = User.query.get_or_404(id)
 	form = EditProfileAdminForm(user=user)
 	if form.validate_on_submit():
-		user.email = form.email.data
+		if user.email != form.email.data:
+			user.email = form.email.data
+			user.avatar_hash = email_hash(user.email)
 		user.username = form.username.data
 		user.confirmed = form.confirmed.data
-		user.role = Role.query.get(form.role.data)
+		user.role_id = form.role.data
 		user.name = form.name.data
 		user.location = form.location.data
 		user.about_me = form.about_me.data
@@ -268,6 +422,7 @@ def edit_profile_admin(id):
 	form.email.data = user.email
 	form.username.data = user.username
 	form.confirmed.data = user.confirmed
+	form.role.data = user.role_id
 	form.name.data = user.name
 	form.location.data = user.location
 	form.about_me.data = user.about_me
@@ -285,11 +440,13 @@ def follow(username):
 	if current_user.is_following(user):
 		flash('You are already following this user.', '')
 		return redirect(url_for('.user', username=username))
+	queue_email(
+		user.email, 'followed_by', username=user.username, user_id=user.id,
+		follower=dict(
+			id=current_user.id, username=current_user.username,
+			url=url_for('.user', username=current_user.username, _external=True)))
+	# follow() commits, taking the queued notification with it
 	current_user.follow(user)
-	send_email(
-		user.email,
-		'{} is now following you'.format(current_user.username),
-		'auth/email/followed_by', user=user, current_user=current_user)
 	flash('You are now following {}.'.format(username), 'success')
 	return redirect(url_for('.user', username=username))
 
@@ -312,8 +469,7 @@ def unfollow(username):
 @main.route('/delete-record/<hashed_id>')
 @login_required
 def delete_record(hashed_id):
-	decoded_id = decode_id(str(hashed_id))
-	record = Title.query.filter_by(id=decoded_id).first_or_404()
+	record = Title.query.filter_by(id=decode_id(hashed_id)).first_or_404()
 	image = Image.query.filter_by(record_id=record.id).first()
 
 	if record.owner_id == current_user.id:
@@ -333,32 +489,65 @@ def delete_record(hashed_id):
 		return redirect(url_for('.user', username=current_user.username))
 
 
+@main.route('/import/<username>', methods=['POST'])
+@login_required
+def import_records(username):
+	"""Import a CSV in the download layout, streaming JSON lines of progress"""
+	user = User.query.filter_by(username=username).first_or_404()
+	if user != current_user:
+		abort(403)
+
+	form = ImportCollectionForm()
+	if not form.validate_on_submit():
+		return jsonify(errors=form.errors), 400
+
+	config = current_app.config
+	progress = iter_import(
+		user, form.csv_file.data.stream,
+		chunk_size=config['RECORDBIN_IMPORT_CHUNK_SIZE'],
+		max_errors=config['RECORDBIN_IMPORT_MAX_ERRORS'])
+	try:
+		# Reads the header, so a file that cannot be imported fails with a 400
+		first = next(progress)
+	except CollectionImportError as e:
+		return jsonify(errors={'csv_file': [str(e)]}), 400
+
+	def generate():
+		result = first
+		yield json.dumps({'rows': result.rows, 'added': result.added}) + '\n'
+		for result in progress:
+			yield json.dumps({'rows': result.rows, 'added': result.added}) + '\n'
+		summary = result.to_json()
+		summary['done'] = True
+		yield json.dumps(summary) + '\n'
+
+	return current_app.response_class(
+		stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @main.route('/download/<username>')
 @login_required
 def download(username):
-	import StringIO
-	import csv
 	user = User.query.filter_by(username=username).first()
-	if user == current_user:
-
-		head_column = ["Artist", "Title", "Color", "Year", "Size", "Date Added"]
-
-		si = StringIO.StringIO()
-		cw = csv.writer(si)
-		cw.writerow(head_column)
-
-		sorted_list = sorted(user.owned_records(), key=lambda x: (x[2], x[1], x[0].year, x[0].name))
-		for row in sorted_list:
-			title, artist, size, format, mail = row
-			cw.writerow([
-				artist, title.name,
-				title.color, title.year,
-				size, title.timestamp.strftime('%m/%d/%y')])
-
-		output = make_response(si.getvalue())
-		now = datetime.now().strftime('%m/%d/%y')
-		output.headers["Content-Disposition"] = "attachment; filename={}_records_{}.csv".format(username, now)
-		output.headers["Content-type"] = "text/csv"
-		return output
-	else:
+	if user != current_user:
 		return redirect(url_for('main.index'))
+
+	# ?format= picks the layout: csv (default), jsonl, or archive (.tar.gz)
+	# GzipMiddleware compresses csv and jsonl on the way out; an archive
+	# is gzip itself, at the same level
+	export_format = request.args.get('format', 'csv')
+	if export_format == 'csv':
+		chunks, extension, mimetype = iter_csv(user), 'csv', 'text/csv'
+	elif export_format == 'jsonl':
+		chunks, extension, mimetype = iter_jsonl(user), 'jsonl', 'application/x-ndjson'
+	elif export_format == 'archive':
+		level = current_app.config['RECORDBIN_GZIP_LEVEL'] or 6
+		chunks, extension, mimetype = iter_archive(user, level), 'tar.gz', 'application/gzip'
+	else:
+		abort(400)
+
+	headers = {
+		'Content-Disposition': 'attachment; filename={}_records_{}.{}'.format(
+			username, datetime.now().strftime('%m/%d/%y'), extension)}
+	return current_app.response_class(
+		stream_with_context(chunks), mimetype=mimetype, headers=headers)
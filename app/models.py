@@ -1,5 +1,8 @@
 from . import db
 from . import login_manager
+from .notifications import hub
+from .cache import TTLCache
+from .lookups import lookups
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
@@ -9,18 +12,35 @@ from datetime import datetime
 from dateutil import tz
 import os
 import base64
+import json
+from collections import namedtuple
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 
 
-def gravatar(email, size=100, default='identicon', rating='g'):
-	if request.is_secure:
-		url = 'https://secure.gravatar.com/avatar'
-	else:
-		url = 'http://www.gravatar.com/avatar'
+_avatar_urls = TTLCache(maxsize=8192, ttl=24 * 60 * 60)
 
-	hash = hashlib.md5(email.encode('utf-8')).hexdigest()
 
-	return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
-		url=url, hash=hash, size=size, default=default, rating=rating)
+def email_hash(email):
+	return hashlib.md5(email.encode('utf-8')).hexdigest()
+
+
+def avatar_url(avatar_hash, size=100, default='identicon', rating='g'):
+	"""Gravatar URL for an `avatar_hash`, built once per hash, size and scheme"""
+	secure = request.is_secure
+	key = (avatar_hash, size, default, rating, secure)
+	url = _avatar_urls.get(key)
+	if url is None:
+		if secure:
+			base = 'https://secure.gravatar.com/avatar'
+		else:
+			base = 'http://www.gravatar.com/avatar'
+		url = '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
+			url=base, hash=avatar_hash, size=size, default=default, rating=rating)
+		_avatar_urls.set(key, url)
+	return url
 
 
 def user_local_time(utctime):
@@ -33,28 +53,142 @@ def user_local_time(utctime):
 	return user_time
 
 
-def encode_id(string):
-	key = os.environ.get('SECRET_KEY')
-	string = str(string)
-	encoded_chars = []
-	for i in range(len(string)):
-		key_c = key[i % len(key)]
-		encoded_c = chr(ord(string[i]) + ord(key_c) % 256)
-		encoded_chars.append(encoded_c)
-	encoded_string = "".join(encoded_chars)
-	return base64.urlsafe_b64encode(encoded_string)
+# Record ids are published as a keyed permutation of the integer id: a
+# four-round Feistel network over 64 bits, rendered as 16 hex digits
+_ID_ROUNDS = 4
+_id_round_keys = {}
+
+
+# Ids are INTEGER columns; anything larger cannot be bound on every backend
+_MAX_ID = 2 ** 31 - 1
+
+
+def _round_keys(secret):
+	keys = _id_round_keys.get(secret)
+	if keys is None:
+		digest = hashlib.sha256('record-id:' + (secret or '')).digest()
+		keys = _id_round_keys[secret] = [
+			int(digest[i * 4:i * 4 + 4].encode('hex'), 16) for i in range(_ID_ROUNDS)]
+	return keys
+
+
+def _mix(value, key):
+	value = (value ^ key) & 0xFFFFFFFF
+	value = (((value >> 16) ^ value) * 0x45d9f3b) & 0xFFFFFFFF
+	value = (((value >> 16) ^ value) * 0x45d9f3b) & 0xFFFFFFFF
+	return (value >> 16) ^ value
+
+
+def _permute(number, keys):
+	left, right = number >> 32, number & 0xFFFFFFFF
+	for key in keys:
+		left, right = right, left ^ _mix(right, key)
+	return (left << 32) | right
+
+
+def _unpermute(number, keys):
+	left, right = number >> 32, number & 0xFFFFFFFF
+	for key in reversed(keys):
+		left, right = right ^ _mix(left, key), left
+	return (left << 32) | right
+
+
+def encode_ids(ids):
+	"""Opaque public ids for a batch of integer ids"""
+	keys = _round_keys(current_app.config['SECRET_KEY'])
+	return ['%016x' % _permute(int(record_id), keys) for record_id in ids]
+
+
+def decode_ids(strings):
+	"""Integer ids for a batch of public ids; None for any that are invalid"""
+	keys = _round_keys(current_app.config['SECRET_KEY'])
+	ids = []
+	for string in strings:
+		try:
+			if len(string) != 16 or string.lstrip('0123456789abcdef'):
+				raise ValueError
+			record_id = _unpermute(int(string, 16), keys)
+			# Well-formed strings can still decode past any primary key
+			if not 0 < record_id <= _MAX_ID:
+				raise ValueError
+			ids.append(record_id)
+		except (TypeError, ValueError):
+			ids.append(None)
+	return ids
+
+
+def encode_id(record_id):
+	return encode_ids([record_id])[0]
 
 
 def decode_id(string):
-	key = os.environ.get('SECRET_KEY')
-	decoded_chars = []
-	string = base64.urlsafe_b64decode(string)
-	for i in range(len(string)):
-		key_c = key[i % len(key)]
-		encoded_c = chr(abs(ord(string[i]) - ord(key_c) % 256))
-		decoded_chars.append(encoded_c)
-	decoded_string = "".join(decoded_chars)
-	return int(decoded_string.encode('ascii', 'ignore'))
+	return decode_ids([string])[0]
+
+
+SIZE_WORDS = {7: 'seven', 10: 'ten', 12: 'twelve'}
+
+RecordGroup = namedtuple('RecordGroup', ['id', 'size', 'format', 'mail', 'records'])
+
+
+def group_records(records, sizes, formats):
+	"""Bucket owned_records() rows by (size, format, mail) in one pass
+
+	One group is returned for every Size/Format row, in table order, with
+	the in-hand groups ahead of the incoming (mail) ones. Row order within
+	a group is preserved.
+	"""
+	groups = []
+	buckets = {}
+	for mail in (0, 1):
+		for f in formats:
+			for size in sizes:
+				group_id = '{}_inches'.format(SIZE_WORDS.get(size.name, size.name))
+				if f.id != 1:
+					group_id += '_' + f.name
+				if mail:
+					group_id += '_mail'
+				group = RecordGroup(group_id, size, f, mail, [])
+				groups.append(group)
+				buckets[(size.name, f.name, mail)] = group.records
+
+	for record in records:
+		bucket = buckets.get((record[2], record[3], record[4]))
+		if bucket is not None:
+			bucket.append(record)
+	return groups
+
+
+def record_cursor(record):
+	"""Opaque keyset cursor pointing just past an owned_records() row"""
+	key = [record[1], record[0].year or 0, record[0].id]
+	return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def parse_cursor(cursor):
+	"""Inverse of record_cursor; None for anything malformed"""
+	try:
+		artist, year, record_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+		return unicode(artist), int(year), int(record_id)
+	except (TypeError, ValueError):
+		return None
+
+
+FEED_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def feed_cursor(record):
+	"""Opaque cursor for a follower_records() row: its (timestamp, title id)"""
+	key = [record[4].strftime(FEED_CURSOR_FORMAT), record[0].id]
+	return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def parse_feed_cursor(cursor):
+	"""Inverse of feed_cursor; None for anything malformed"""
+	try:
+		timestamp, title_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+		return datetime.strptime(timestamp, FEED_CURSOR_FORMAT), int(title_id)
+	except (TypeError, ValueError):
+		return None
 
 
 class Permission:
@@ -92,6 +226,16 @@ class Role(db.Model):
 	def __init__(self, name):
 		self.name = name
 
+	@staticmethod
+	def permissions_for(role_id):
+		"""Permission bits of a role, from the identity cache when possible"""
+		cache = identity_cache(current_app)
+		permissions = cache.get('roles')
+		if permissions is None:
+			permissions = dict(db.session.query(Role.id, Role.permissions).all())
+			cache.set('roles', permissions)
+		return permissions.get(role_id)
+
 	def __repr__(self):
 		return '<Role {}>'.format(self.name)
 
@@ -103,6 +247,56 @@ class Follow(db.Model):
 	timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class FeedItem(db.Model):
+	"""One title in one user's activity feed, written when the title is added"""
+	__tablename__ = 'feed_items'
+	__table_args__ = (
+		db.Index('ix_feed_items_user_timestamp', 'user_id', 'timestamp'),
+		db.Index('ix_feed_items_user_owner', 'user_id', 'owner_id'))
+	user_id = db.Column(db.Integer, db.ForeignKey('users_table.id'), primary_key=True)
+	title_id = db.Column(db.Integer, db.ForeignKey('titles.id'), primary_key=True, index=True)
+	owner_id = db.Column(db.Integer, db.ForeignKey('users_table.id'))
+	timestamp = db.Column(db.DateTime)
+
+	@staticmethod
+	def fan_out(title):
+		"""Add a new title to the feed of everyone following its owner"""
+		followers = db.select([
+			Follow.follower_id, db.literal(title.id), db.literal(title.owner_id),
+			db.literal(title.timestamp, db.DateTime)]) \
+			.where(Follow.followed_id == title.owner_id)
+		db.session.execute(FeedItem.__table__.insert().from_select(
+			['user_id', 'title_id', 'owner_id', 'timestamp'], followers))
+
+	@staticmethod
+	def copy_in(follower, followed, limit):
+		"""Seed a new follow with the followed user's latest titles"""
+		latest = db.select([
+			db.literal(follower.id), Title.id, Title.owner_id, Title.timestamp]) \
+			.where(Title.owner_id == followed.id) \
+			.order_by(Title.timestamp.desc(), Title.id.desc()).limit(limit)
+		db.session.execute(FeedItem.__table__.insert().from_select(
+			['user_id', 'title_id', 'owner_id', 'timestamp'], latest))
+
+	@staticmethod
+	def rebuild(limit):
+		"""Refill every feed from follows, `limit` latest titles per follow"""
+		ranked = db.select([
+			Follow.follower_id.label('user_id'), Title.id.label('title_id'),
+			Title.owner_id.label('owner_id'), Title.timestamp.label('timestamp'),
+			db.func.row_number().over(
+				partition_by=[Follow.follower_id, Title.owner_id],
+				order_by=[Title.timestamp.desc(), Title.id.desc()]).label('position')]) \
+			.where(Follow.followed_id == Title.owner_id).alias()
+
+		FeedItem.query.delete()
+		db.session.execute(FeedItem.__table__.insert().from_select(
+			['user_id', 'title_id', 'owner_id', 'timestamp'],
+			db.select([ranked.c.user_id, ranked.c.title_id, ranked.c.owner_id, ranked.c.timestamp])
+			.where(ranked.c.position <= limit)))
+		db.session.commit()
+
+
 class User(UserMixin, db.Model):
 	__tablename__ = 'users_table'
 	id = db.Column(db.Integer, primary_key=True)
@@ -118,6 +312,24 @@ class User(UserMixin, db.Model):
 	avatar_hash = db.Column(db.String(32))
 	migrate_test = db.Column(db.String(32))
 
+	# Denormalized counters, kept in step by Title/Follow writes
+	records_count = db.Column(db.Integer, default=0, server_default='0')
+	followers_count = db.Column(db.Integer, default=0, server_default='0')
+	followed_count = db.Column(db.Integer, default=0, server_default='0')
+	# Moved on by every Title/Image write; keys cached renderings of the collection
+	collection_version = db.Column(db.Integer, default=0, server_default='0')
+	# Moved on when the profile page shows something new about the user or the
+	# people in their follow lists; counters and collection have their own
+	profile_version = db.Column(db.Integer, default=0, server_default='0')
+
+	# Columns the user directory shows, the user's profile page shows, and
+	# the follow lists on other users' profiles show
+	DIRECTORY_COLUMNS = (
+		'username', 'email', 'avatar_hash', 'records_count', 'member_since', 'last_seen')
+	PROFILE_COLUMNS = (
+		'username', 'email', 'avatar_hash', 'location', 'member_since', 'role_id')
+	LISTED_COLUMNS = ('username', 'email', 'avatar_hash')
+
 	# FK & Relationship
 	role_id = db.Column(db.Integer, db.ForeignKey('roles.id'), default=2)
 	followed = db.relationship(
@@ -132,29 +344,41 @@ class User(UserMixin, db.Model):
 		backref=db.backref(
 			'followed', lazy='joined'), lazy='dynamic', cascade='all, delete-orphan')
 
-	def gravatar(self, size=100, default='identicon', rating='g'):
-		if request.is_secure:
-			url = 'https://secure.gravatar.com/avatar'
-		else:
-			url = 'http://www.gravatar.com/avatar'
-
-		hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
+	@staticmethod
+	def fill_avatar_hashes():
+		"""Hash the email of users saved before avatar_hash was kept"""
+		for user in User.query.filter(User.avatar_hash == None, User.email != None):
+			user.avatar_hash = email_hash(user.email)
+		db.session.commit()
 
-		return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
-			url=url, hash=hash, size=size, default=default, rating=rating)
+	def gravatar(self, size=100, default='identicon', rating='g'):
+		avatar_hash = self.avatar_hash
+		if avatar_hash is None and self.email is not None:
+			avatar_hash = email_hash(self.email)
+		return avatar_url(avatar_hash, size=size, default=default, rating=rating)
 
 	def follow(self, user):
 		if not self.is_following(user):
 			f = Follow(follower=self, followed=user)
 			db.session.add(f)
+			User.bump_counter(self.id, User.followed_count, 1)
+			User.bump_counter(user.id, User.followers_count, 1)
+			FeedItem.copy_in(self, user, current_app.config['RECORDBIN_FEED_BACKFILL'])
 			db.session.commit()
 
 	def unfollow(self, user):
 		f = self.followed.filter_by(followed_id=user.id).first()
 		if f:
 			db.session.delete(f)
+			User.bump_counter(self.id, User.followed_count, -1)
+			User.bump_counter(user.id, User.followers_count, -1)
+			FeedItem.query.filter_by(user_id=self.id, owner_id=user.id).delete()
 			db.session.commit()
 
+	def followed_ids(self):
+		return [row[0] for row in db.session.query(Follow.followed_id)
+			.filter(Follow.follower_id == self.id).all()]
+
 	def is_following(self, user):
 		return self.followed.filter_by(
 			followed_id=user.id).first() is not None
@@ -169,25 +393,93 @@ class User(UserMixin, db.Model):
 			.join(Size, Title.size_id == Size.id) \
 			.join(Format, Title.format_id == Format.id) \
 			.add_columns(Artist.name, Size.name, Format.name, Title.mail) \
-			.filter(Title.owner_id == self.id).all()
-
-	def follower_records(self):
-		return Title.query.join(
-			Follow, Follow.followed_id == Title.owner_id) \
-			.join(User, Follow.followed_id == User.id) \
+			.filter(Title.owner_id == self.id) \
+			.order_by(*Title.collection_order()).all()
+
+	def records_page(
+		self, size_id=None, format_id=None, mail=None, after=None, limit=100,
+		title_ids=None):
+		"""One keyset page of owned records, with each row's image url appended
+
+		Rows are ordered by (artist, year, id); `after` is a parsed cursor
+		and only rows strictly past it are returned. `title_ids` narrows the
+		page to a select of ids, such as search.matching_ids().
+		"""
+		query = Title.query.join(
+			Artist, Title.artist_id == Artist.id) \
+			.join(Size, Title.size_id == Size.id) \
+			.join(Format, Title.format_id == Format.id) \
+			.outerjoin(Image, Image.record_id == Title.id) \
+			.add_columns(Artist.name, Size.name, Format.name, Title.mail, Image.image_url) \
+			.filter(Title.owner_id == self.id)
+
+		if size_id is not None:
+			query = query.filter(Title.size_id == size_id)
+		if format_id is not None:
+			query = query.filter(Title.format_id == format_id)
+		if mail is not None:
+			query = query.filter(Title.mail == mail)
+		if title_ids is not None:
+			query = query.filter(Title.id.in_(title_ids))
+		if after is not None:
+			artist_key, year_key, id_key = Title.collection_order()
+			artist, year, record_id = after
+			artist = db.func.lower(artist)
+			query = query.filter(db.or_(
+				artist_key > artist,
+				db.and_(artist_key == artist, year_key > year),
+				db.and_(artist_key == artist, year_key == year, id_key > record_id)))
+
+		return query.order_by(*Title.collection_order()).limit(limit).all()
+
+	def record_group_counts(self):
+		"""Record totals keyed by (size, format, mail) names, as in group_records"""
+		counts = db.session.query(Size.name, Format.name, Title.mail, db.func.count(Title.id)) \
+			.join(Title, Title.size_id == Size.id) \
+			.join(Format, Title.format_id == Format.id) \
+			.filter(Title.owner_id == self.id) \
+			.group_by(Size.name, Format.name, Title.mail).all()
+		return {(size, f, mail): n for size, f, mail, n in counts}
+
+	def follower_records(self, since=None, before=None):
+		"""Latest titles from followed users, newest first, read from feed_items
+
+		`since` and `before` are parsed feed cursors. With `since` only newer
+		items are returned, oldest first, so a limit never skips any.
+		"""
+		query = Title.query.join(
+			FeedItem, FeedItem.title_id == Title.id) \
+			.join(User, FeedItem.owner_id == User.id) \
 			.join(Artist, Title.artist_id == Artist.id) \
-			.add_columns(User.email, Artist.name, User.username) \
-			.filter(Follow.follower_id == self.id).order_by(Title.timestamp.desc())
+			.add_columns(User.avatar_hash, Artist.name, User.username, FeedItem.timestamp) \
+			.filter(FeedItem.user_id == self.id)
+
+		if before is not None:
+			timestamp, title_id = before
+			query = query.filter(db.or_(
+				FeedItem.timestamp < timestamp,
+				db.and_(FeedItem.timestamp == timestamp, FeedItem.title_id < title_id)))
+		if since is not None:
+			timestamp, title_id = since
+			return query.filter(db.or_(
+				FeedItem.timestamp > timestamp,
+				db.and_(FeedItem.timestamp == timestamp, FeedItem.title_id > title_id))) \
+				.order_by(FeedItem.timestamp, FeedItem.title_id)
+		return query.order_by(FeedItem.timestamp.desc(), FeedItem.title_id.desc())
 
 	def __init__(self, **kwargs):
 		super(User, self).__init__(**kwargs)
-		if self.role is None:
+		if self.role is None and self.role_id is None:
+			registry = lookups()
+			role = None
 			if self.email == current_app.config['RECORDBIN_ADMIN']:
-				self.role = Role.query.filter_by(name='admin').first()
-			if self.role is None:
-				self.role = Role.query.filter_by(name='user').first()
+				role = registry.role('admin')
+			if role is None:
+				role = registry.role('user')
+			if role is not None:
+				self.role_id = role.id
 		if self.email is not None and self.avatar_hash is None:
-			self.avatar_hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
+			self.avatar_hash = email_hash(self.email)
 
 	def change_email(self, token):
 		s = Serializer(current_app.config['SECRET_KEY'])
@@ -203,7 +495,7 @@ class User(UserMixin, db.Model):
 		if self.query.filter_by(email=new_email).first() is not None:
 			return False
 		self.email = new_email
-		self.avatar_hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
+		self.avatar_hash = email_hash(self.email)
 		db.session.add(self)
 		db.session.commit()
 		return True
@@ -225,7 +517,10 @@ class User(UserMixin, db.Model):
 		raise AttributeError('Password is not a readable attribute')
 
 	def can(self, permissions):
-		return self.role is not None and (self.role.permissions & permissions) == permissions
+		# A role already on the instance may not be flushed to role_id yet
+		role = self.__dict__.get('role')
+		granted = role.permissions if role is not None else Role.permissions_for(self.role_id)
+		return granted is not None and (granted & permissions) == permissions
 
 	def is_administrator(self):
 		return self.can(Permission.ADMINISTER)
@@ -309,9 +604,9 @@ class User(UserMixin, db.Model):
 			"email": self.email,
 			'member_since': self.member_since,
 			'last_seen': self.last_seen,
-			"owned_record_count": len(self.owned_records()),
-			"users_following:": len(self.followed.all()),
-			"users_followed_by": len(self.followers.all()),
+			"owned_record_count": self.records_count,
+			"users_following:": self.followed_count,
+			"users_followed_by": self.followers_count,
 			"name": self.name,
 			"about_me": self.about_me
 		}
@@ -320,7 +615,65 @@ class User(UserMixin, db.Model):
 
 	@staticmethod
 	def record_count(self):
-		return len(self.owned_records())
+		return self.records_count
+
+	@staticmethod
+	def record_counts():
+		"""Owned record totals for every user in one grouped query"""
+		counts = db.session.query(Title.owner_id, db.func.count(Title.id)) \
+			.group_by(Title.owner_id).all()
+		return dict(counts)
+
+	@staticmethod
+	def bump_counter(user_id, column, delta):
+		"""Atomically adjust a counter column inside the current transaction"""
+		if not delta:
+			return
+		User.query.filter_by(id=user_id).update(
+			{column: column + delta}, synchronize_session=False)
+		# Bulk updates skip mapper events; drop the cached row on commit
+		db.session.info.setdefault('identity_changes', set()).add(('user', user_id))
+		if column.key in User.DIRECTORY_COLUMNS:
+			Stamp.touch('users')
+
+	@staticmethod
+	def rebuild_counters():
+		"""Recompute every user's counters in one bulk UPDATE"""
+		def count_of(column, ref):
+			return db.select([db.func.count()]) \
+				.where(column == ref).as_scalar()
+
+		User.query.update({
+			User.records_count: count_of(Title.owner_id, User.id),
+			User.followers_count: count_of(Follow.followed_id, User.id),
+			User.followed_count: count_of(Follow.follower_id, User.id)
+		}, synchronize_session=False)
+		db.session.commit()
+
+	@staticmethod
+	def check_counters():
+		"""Return (username, counter, stored, actual) for every drifted counter"""
+		actual = {
+			'records_count': User.record_counts(),
+			'followers_count': dict(
+				db.session.query(Follow.followed_id, db.func.count())
+				.group_by(Follow.followed_id).all()),
+			'followed_count': dict(
+				db.session.query(Follow.follower_id, db.func.count())
+				.group_by(Follow.follower_id).all())
+		}
+		rows = db.session.query(
+			User.id, User.username, User.records_count,
+			User.followers_count, User.followed_count).all()
+
+		drifted = []
+		for row in rows:
+			for counter in ('records_count', 'followers_count', 'followed_count'):
+				stored = getattr(row, counter) or 0
+				expected = actual[counter].get(row.id, 0)
+				if stored != expected:
+					drifted.append((row.username, counter, stored, expected))
+		return drifted
 
 
 class Title(db.Model):
@@ -334,8 +687,10 @@ class Title(db.Model):
 	format_id = db.Column(db.Integer, db.ForeignKey('formats.id'), default=1)
 	notes = db.Column(db.String(128))
 	timestamp = db.Column(db.DateTime, default=user_local_time(datetime.utcnow))
-	owner_id = db.Column(db.Integer, db.ForeignKey('users_table.id'))
+	owner_id = db.Column(db.Integer, db.ForeignKey('users_table.id'), index=True)
 	mail = db.Column(db.Integer, default=0)
+	# Digest of the fields that make a title a duplicate; see content_key_for
+	content_key = db.Column(db.String(40), unique=True, index=True)
 
 	# Methods
 	def __init__(
@@ -351,12 +706,76 @@ class Title(db.Model):
 		self.notes = notes
 		self.mail = mail
 
-	def add_to_table(self):
+	@staticmethod
+	def collection_order():
+		"""Sort key of a collection listing: artist, year, then id"""
+		return (db.func.lower(Artist.name), db.func.coalesce(Title.year, 0), Title.id)
+
+	@staticmethod
+	def content_key_for(artist_id, name, year, size_id, color, notes, owner_id):
+		"""Key two titles share when one owner adds the same record twice
+
+		Free-text fields are compared case-insensitively with whitespace
+		collapsed; the unique index on content_key enforces the check.
+		"""
+		def normalize(value):
+			return u' '.join(unicode(value if value is not None else u'').lower().split())
+
+		fields = (artist_id, name, year, size_id, color, notes, owner_id)
+		return hashlib.sha1(
+			u'\x1f'.join(normalize(field) for field in fields).encode('utf-8')).hexdigest()
+
+	def refresh_content_key(self):
+		self.content_key = Title.content_key_for(
+			self.artist_id, self.name, self.year, self.size_id,
+			self.color, self.notes, self.owner_id)
+
+	@staticmethod
+	def rebuild_content_keys():
+		"""Backfill content keys; returns ids left unkeyed as duplicates"""
+		seen = set()
+		keys = []
+		duplicates = []
+		rows = db.session.query(
+			Title.id, Title.artist_id, Title.name, Title.year, Title.size_id,
+			Title.color, Title.notes, Title.owner_id).order_by(Title.id)
+		for row in rows:
+			key = Title.content_key_for(*row[1:])
+			if key in seen:
+				key = None
+				duplicates.append(row[0])
+			seen.add(key)
+			keys.append({'title_id': row[0], 'key': key})
+
+		titles = Title.__table__
+		db.session.execute(titles.update().values(content_key=None))
+		if keys:
+			db.session.execute(
+				titles.update()
+				.where(titles.c.id == db.bindparam('title_id'))
+				.values(content_key=db.bindparam('key')), keys)
+		db.session.commit()
+		return duplicates
+
+	def add_to_table(self, image_url=None):
+		"""Insert the title, its image and feed rows in one transaction
+
+		Raises IntegrityError if the owner already has this title; the
+		caller is expected to roll back.
+		"""
 		db.session.add(self)
+		User.bump_counter(self.owner_id, User.records_count, 1)
+		db.session.flush()
+		if image_url:
+			db.session.add(Image(record_id=self.id, image_url=image_url))
+		FeedItem.fan_out(self)
 		db.session.commit()
+		hub.publish(self.owner_id, {'title_id': self.id})
 
 	def delete_from_table(self):
+		FeedItem.query.filter_by(title_id=self.id).delete()
 		db.session.delete(self)
+		User.bump_counter(self.owner_id, User.records_count, -1)
 		db.session.commit()
 
 	def update_from_mail(self):
@@ -364,8 +783,29 @@ class Title(db.Model):
 			self.mail = 0
 			self.timestamp = datetime.now()
 			db.session.add(self)
+			FeedItem.query.filter_by(title_id=self.id).update(
+				{FeedItem.timestamp: self.timestamp}, synchronize_session=False)
 			db.session.commit()
 
+	@staticmethod
+	def collection_json(record, encode_id):
+		"""Serialize a records_page() row for the collection API"""
+		title, artist, size, format, mail, image_url = record
+		return {
+			"id": encode_id(title.id),
+			"artist": artist,
+			"title": title.name,
+			"color": title.color,
+			"year": title.year,
+			"notes": title.notes,
+			"added": title.timestamp.strftime('%-m/%-d/%y'),
+			"image": image_url,
+			"size": size,
+			"size_id": title.size_id,
+			"format": format,
+			"mail": mail
+		}
+
 	def to_json(self):
 		json_title = {
 			"name": self.name,
@@ -446,8 +886,122 @@ class Artist(db.Model):
 		db.session.commit()
 
 	def delete_from_table(self):
+		name = self.name
 		db.session.delete(self)
 		db.session.commit()
+		artist_cache(current_app).delete(name)
+
+	@staticmethod
+	def resolve(name):
+		"""Id of the artist called `name`, inserting it if it is new"""
+		return Artist.resolve_many([name])[name]
+
+	@staticmethod
+	def resolve_many(names):
+		"""Map each of `names` to an artist id, inserting the missing ones
+
+		Names missing from the cache cost an INSERT ... ON CONFLICT DO NOTHING
+		RETURNING on PostgreSQL, plus a SELECT for the existing names it did
+		not return. Elsewhere they cost a SELECT, and for names still missing
+		an insert-or-ignore and a second SELECT. Either way two requests
+		adding the same new artist both end up with its id instead of one
+		failing on the unique name. Nothing is committed here; new ids are
+		only cached once the caller's transaction commits.
+		"""
+		cache = artist_cache(current_app)
+		ids = {}
+		missing = set()
+		for name in names:
+			artist_id = cache.get(name)
+			if artist_id is None:
+				missing.add(name)
+			else:
+				ids[name] = artist_id
+		if not missing:
+			return ids
+
+		if db.engine.dialect.name == 'postgresql':
+			created = Artist._insert_returning(missing)
+			found = Artist._ids_for(missing.difference(created))
+			for name, artist_id in found.items():
+				cache.set(name, artist_id)
+			db.session.info.setdefault('new_artists', {}).update(created)
+			ids.update(found)
+			ids.update(created)
+			return ids
+
+		found = Artist._ids_for(missing)
+		for name, artist_id in found.items():
+			cache.set(name, artist_id)
+		ids.update(found)
+		missing.difference_update(found)
+		if not missing:
+			return ids
+
+		Artist._insert_ignore(missing)
+		created = Artist._ids_for(missing)
+		db.session.info.setdefault('new_artists', {}).update(created)
+		ids.update(created)
+		return ids
+
+	@staticmethod
+	def _ids_for(names):
+		ids = {}
+		names = list(names)
+		# Stay well under SQLite's bound parameter limit
+		for start in xrange(0, len(names), 500):
+			ids.update(db.session.query(Artist.name, Artist.id)
+				.filter(Artist.name.in_(names[start:start + 500])).all())
+		return ids
+
+	@staticmethod
+	def _insert_returning(names):
+		"""{name: id} of the artists among `names` this statement inserted"""
+		created = {}
+		# Sorted, so concurrent inserts wait on each other's names in the same order
+		names = sorted(names)
+		for start in xrange(0, len(names), 500):
+			rows = db.session.execute(
+				db.text(ARTIST_INSERT_RETURNING), {'names': names[start:start + 500]})
+			created.update((name, artist_id) for artist_id, name in rows)
+		return created
+
+	@staticmethod
+	def _insert_ignore(names):
+		params = [{'name': name} for name in names]
+		statement = ARTIST_INSERT_IGNORE.get(db.engine.dialect.name)
+		if statement is not None:
+			db.session.execute(db.text(statement), params)
+			return
+		for param in params:
+			savepoint = db.session.begin_nested()
+			try:
+				db.session.execute(Artist.__table__.insert(), param)
+				savepoint.commit()
+			except IntegrityError:
+				savepoint.rollback()
+
+
+# DO UPDATE rather than DO NOTHING, so existing names return their id too;
+# xmax is 0 only on rows this statement inserted
+# Existing names are skipped without being locked or rewritten
+ARTIST_INSERT_RETURNING = (
+	"INSERT INTO artists (name) SELECT unnest(:names) "
+	"ON CONFLICT (name) DO NOTHING RETURNING id, name")
+
+ARTIST_INSERT_IGNORE = {
+	'sqlite': "INSERT OR IGNORE INTO artists (name) VALUES (:name)",
+	'postgresql': "INSERT INTO artists (name) VALUES (:name) ON CONFLICT (name) DO NOTHING",
+	'mysql': "INSERT IGNORE INTO artists (name) VALUES (:name)"}
+
+
+def artist_cache(app):
+	"""The worker's bounded artist name -> id cache for `app`"""
+	cache = app.extensions.get('artist_ids')
+	if cache is None:
+		cache = app.extensions['artist_ids'] = TTLCache(
+			app.config['RECORDBIN_ARTIST_CACHE_SIZE'], app.config['RECORDBIN_ARTIST_CACHE_TTL'])
+	return cache
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -459,7 +1013,7 @@ class AnonymousUser(AnonymousUserMixin):
 
 class Image(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
-	record_id = db.Column(db.Integer, db.ForeignKey('titles.id'))
+	record_id = db.Column(db.Integer, db.ForeignKey('titles.id'), index=True)
 	image_url = db.Column(db.String(512))
 
 	def add_to_table(self):
@@ -471,9 +1025,272 @@ class Image(db.Model):
 		db.session.commit()	
 
 
+class Stamp(db.Model):
+	"""Version counter of a page built from many rows, e.g. the user directory"""
+	__tablename__ = 'stamps'
+	name = db.Column(db.String(32), primary_key=True)
+	version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	changed = db.Column(db.DateTime, default=datetime.utcnow)
+
+	NAMES = ('users',)
+
+	@staticmethod
+	def insert_stamps():
+		for name in Stamp.NAMES:
+			if Stamp.query.get(name) is None:
+				db.session.add(Stamp(name=name))
+		db.session.commit()
+
+	@staticmethod
+	def read(*names):
+		"""{name: (version, changed)} for `names` in one query; (0, None) if never bumped"""
+		rows = db.session.query(Stamp.name, Stamp.version, Stamp.changed) \
+			.filter(Stamp.name.in_(names)).all()
+		stamps = dict((name, (0, None)) for name in names)
+		stamps.update((name, (version, changed)) for name, version, changed in rows)
+		return stamps
+
+	@staticmethod
+	def touch(*names, **kwargs):
+		"""Bump stamps `names` when the current transaction commits"""
+		session = kwargs.get('session') or db.session
+		session.info.setdefault('stamps', set()).update(names)
+
+
+class OutboxMessage(db.Model):
+	"""An email waiting to be sent by `manage.py send_outbox`; see app/outbox.py"""
+	__tablename__ = 'outbox'
+	id = db.Column(db.Integer, primary_key=True)
+	recipient = db.Column(db.String(64), nullable=False)
+	kind = db.Column(db.String(32), nullable=False)
+	subject = db.Column(db.String(128))
+	template = db.Column(db.String(64))
+	# JSON object the template is rendered with
+	context = db.Column(db.Text)
+	created = db.Column(db.DateTime, default=datetime.utcnow)
+	send_after = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+	sent = db.Column(db.DateTime, index=True)
+	attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	error = db.Column(db.Text)
+	# Sender holding the row until send_after; see app.outbox.drain
+	claimed_by = db.Column(db.String(32))
+
+	def __repr__(self):
+		return '<OutboxMessage {} to {}>'.format(self.kind, self.recipient)
+
+
+def identity_cache(app):
+	"""The worker's cache of user rows and role permissions for `app`"""
+	cache = app.extensions.get('identity_cache')
+	if cache is None:
+		cache = app.extensions['identity_cache'] = TTLCache(
+			app.config['RECORDBIN_IDENTITY_CACHE_SIZE'],
+			app.config['RECORDBIN_IDENTITY_CACHE_TTL'])
+	return cache
+
+
 @login_manager.user_loader
 def load_user(user_id):
-	return User.query.get(int(user_id))
+	user_id = int(user_id)
+	loaded = db.session.identity_map.get(identity_key(User, user_id))
+	if loaded is not None:
+		return loaded
+
+	cache = identity_cache(current_app)
+	key = ('user', user_id)
+	values = cache.get(key)
+	if values is not None:
+		# Rebuild the row as already loaded and attach it without a SELECT
+		user = User.__mapper__.class_manager.new_instance()
+		for name, value in values.items():
+			setattr(user, name, value)
+		make_transient_to_detached(user)
+		db.session.add(user)
+		return user
+
+	user = User.query.get(user_id)
+	if user is not None:
+		cache.set(key, dict(
+			(attr.key, getattr(user, attr.key)) for attr in User.__mapper__.column_attrs))
+	return user
+
+
+def _identity_changed(mapper, connection, target):
+	session = object_session(target)
+	if session is not None:
+		session.info.setdefault('identity_changes', set()).add(
+			('user', target.id) if isinstance(target, User) else 'roles')
+		_evict_identities(session)
+
+
+def _shown(value):
+	# Pages show dates to the day
+	return value.date() if isinstance(value, datetime) else value
+
+
+def _shown_changed(target, names):
+	"""Whether the flushed update of `target` changed what `names` look like on a page"""
+	attrs = inspect(target).attrs
+	for name in names:
+		history = attrs[name].history
+		if history.has_changes() and \
+				set(map(_shown, history.added)) != set(map(_shown, history.deleted)):
+			return True
+	return False
+
+
+def _user_pages_changed(mapper, connection, target):
+	session = object_session(target)
+	if session is None:
+		return
+	if _shown_changed(target, User.DIRECTORY_COLUMNS):
+		Stamp.touch('users', session=session)
+	profiles = session.info.setdefault('changed_profiles', {})
+	if _shown_changed(target, User.LISTED_COLUMNS):
+		profiles[target.id] = True
+	elif _shown_changed(target, User.PROFILE_COLUMNS):
+		profiles.setdefault(target.id, False)
+
+
+def _user_listed(mapper, connection, target):
+	session = object_session(target)
+	if session is not None:
+		Stamp.touch('users', session=session)
+
+
+def _evict_identities(session):
+	app = getattr(session, 'app', None)
+	changes = session.info.get('identity_changes')
+	if app is None or not changes:
+		return
+	cache = identity_cache(app)
+	for key in changes:
+		cache.delete(key)
+
+
+def _identities_committed(session):
+	# Evict again so a row another request cached mid-transaction is dropped
+	_evict_identities(session)
+	session.info.pop('identity_changes', None)
+
+
+def _session_rolled_back(session):
+	session.info.pop('identity_changes', None)
+	session.info.pop('stamps', None)
+	session.info.pop('changed_collections', None)
+	session.info.pop('changed_profiles', None)
+	session.info.pop('new_artists', None)
+
+
+def _artists_committed(session):
+	created = session.info.pop('new_artists', None)
+	app = getattr(session, 'app', None)
+	if created and app is not None:
+		cache = artist_cache(app)
+		for name, artist_id in created.items():
+			cache.set(name, artist_id)
+
+
+def _title_content_changed(mapper, connection, target):
+	target.refresh_content_key()
+
+
+def _collection_changed(mapper, connection, target):
+	session = object_session(target)
+	if session is not None:
+		owners, records = session.info.setdefault('changed_collections', (set(), set()))
+		if isinstance(target, Title):
+			owners.add(target.owner_id)
+		elif target.record_id is not None:
+			records.add(target.record_id)
+
+
+def _bump_collection_versions(session, flush_context):
+	"""One UPDATE per flush moves on the version of every touched collection"""
+	changed = session.info.pop('changed_collections', None)
+	if not changed:
+		return
+	owners, records = changed
+	connection = session.connection()
+	if records:
+		owners.update(owner_id for owner_id, in connection.execute(
+			db.select([Title.owner_id]).where(Title.id.in_(records))))
+	owners.discard(None)
+	if not owners:
+		return
+	users = User.__table__
+	connection.execute(
+		users.update().where(users.c.id.in_(owners))
+		.values(collection_version=users.c.collection_version + 1))
+	session.info.setdefault('identity_changes', set()).update(
+		('user', owner_id) for owner_id in owners)
+
+
+def _bump_profile_versions(session, flush_context):
+	"""Move on the profile version of changed users, and of everyone listing them"""
+	changed = session.info.pop('changed_profiles', None)
+	if not changed:
+		return
+	users = User.__table__
+	follows = Follow.__table__
+	ids = set(changed)
+	listed = [user_id for user_id, neighbours in changed.items() if neighbours]
+	connection = session.connection()
+	if listed:
+		ids.update(user_id for user_id, in connection.execute(
+			db.select([follows.c.follower_id]).where(follows.c.followed_id.in_(listed))
+			.union(db.select([follows.c.followed_id]).where(follows.c.follower_id.in_(listed)))))
+	connection.execute(
+		users.update().where(users.c.id.in_(ids))
+		.values(profile_version=users.c.profile_version + 1))
+	session.info.setdefault('identity_changes', set()).update(
+		('user', user_id) for user_id in ids)
+
+
+def _bump_stamps(session):
+	"""Move touched stamps on just before COMMIT, so their row locks are brief"""
+	# Mapper events in a pending flush may touch stamps of their own
+	session.flush()
+	names = session.info.pop('stamps', None)
+	if not names:
+		return
+	stamps = Stamp.__table__
+	connection = session.connection()
+	now = datetime.utcnow()
+	for name in sorted(names):
+		result = connection.execute(
+			stamps.update().where(stamps.c.name == name)
+			.values(version=stamps.c.version + 1, changed=now))
+		if not result.rowcount:
+			connection.execute(stamps.insert().values(name=name, version=1, changed=now))
+
+
+def _lookups_changed(mapper, connection, target):
+	app = getattr(object_session(target), 'app', None)
+	if app is not None:
+		lookups(app).invalidate()
+
+
+for model in (User, Role):
+	for name in ('after_insert', 'after_update', 'after_delete'):
+		event.listen(model, name, _identity_changed)
+event.listen(User, 'after_insert', _user_listed)
+event.listen(User, 'after_delete', _user_listed)
+event.listen(User, 'after_update', _user_pages_changed)
+for model in (Title, Image):
+	for name in ('after_insert', 'after_update', 'after_delete'):
+		event.listen(model, name, _collection_changed)
+event.listen(Session, 'after_flush', _bump_collection_versions)
+event.listen(Session, 'after_flush', _bump_profile_versions)
+event.listen(Title, 'before_insert', _title_content_changed)
+event.listen(Title, 'before_update', _title_content_changed)
+for model in (Size, Format, Role):
+	for name in ('after_insert', 'after_update', 'after_delete'):
+		event.listen(model, name, _lookups_changed)
+event.listen(Session, 'before_commit', _bump_stamps)
+event.listen(Session, 'after_commit', _identities_committed)
+event.listen(Session, 'after_commit', _artists_committed)
+event.listen(Session, 'after_rollback', _session_rolled_back)
 
 # make changes -> migrate -> upgrade
 	# python manage.py db migrate -m 'default role id'
@@ -0,0 +1,100 @@
+"""In-process notification hub for pushing feed activity
+
+Title.add_to_table publishes (owner id, event) pairs once its transaction
+commits. Streaming feed connections subscribe with the ids of the users
+they follow and are woken only by activity from those users, then read
+what is new from feed_items themselves.
+
+Delivery goes through a backend with `attach(callback)` and
+`send(owner_id, event)`. LocalBackend hands events straight back to this
+process's hub; it stands in for a cross-worker channel (Redis pub/sub,
+PostgreSQL LISTEN/NOTIFY) which would broadcast `send` to the hub of
+every worker.
+"""
+import threading
+from Queue import Queue, Empty, Full
+
+
+class LocalBackend(object):
+	"""Same-process delivery, the stand-in for a cross-worker channel"""
+
+	def __init__(self):
+		self._callbacks = []
+
+	def attach(self, callback):
+		self._callbacks.append(callback)
+
+	def send(self, owner_id, event):
+		for callback in self._callbacks:
+			callback(owner_id, event)
+
+
+class Subscription(object):
+	"""A bounded queue of events for one streaming connection"""
+
+	def __init__(self, hub, owner_ids, maxsize=100):
+		self.hub = hub
+		self.owner_ids = frozenset(owner_ids)
+		self.queue = Queue(maxsize)
+
+	def put(self, event):
+		# A reader that falls behind only needs waking, not every event
+		try:
+			self.queue.put_nowait(event)
+		except Full:
+			pass
+
+	def get(self, timeout):
+		"""Next event, or None if nothing arrives within `timeout` seconds"""
+		try:
+			return self.queue.get(timeout=timeout)
+		except Empty:
+			return None
+
+	def drain(self):
+		"""Drop queued events; the reader is about to catch up anyway"""
+		while True:
+			try:
+				self.queue.get_nowait()
+			except Empty:
+				return
+
+	def close(self):
+		self.hub.unsubscribe(self)
+
+
+class NotificationHub(object):
+
+	def __init__(self, backend=None):
+		self._lock = threading.Lock()
+		self._watchers = {}
+		self.backend = backend or LocalBackend()
+		self.backend.attach(self.deliver)
+
+	def subscribe(self, owner_ids):
+		subscription = Subscription(self, owner_ids)
+		with self._lock:
+			for owner_id in subscription.owner_ids:
+				self._watchers.setdefault(owner_id, set()).add(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription):
+		with self._lock:
+			for owner_id in subscription.owner_ids:
+				watchers = self._watchers.get(owner_id)
+				if watchers is not None:
+					watchers.discard(subscription)
+					if not watchers:
+						del self._watchers[owner_id]
+
+	def publish(self, owner_id, event):
+		self.backend.send(owner_id, event)
+
+	def deliver(self, owner_id, event):
+		with self._lock:
+			watchers = list(self._watchers.get(owner_id, ()))
+		for subscription in watchers:
+			subscription.put(event)
+
+
+hub = NotificationHub()
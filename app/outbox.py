@@ -0,0 +1,252 @@
+"""Durable outgoing mail
+
+Requests call queue_email, which only adds an OutboxMessage row to the
+request's transaction: nothing is sent, and the message is committed
+together with the change it reports. Messages with a template are
+rendered when sent; those app/email.py queues arrive rendered. `manage.py send_outbox`
+drains the table in batches over one SMTP connection, rendering each
+message as it goes.
+
+Kinds listed in DIGESTS are held for RECORDBIN_OUTBOX_DIGEST_WINDOW
+seconds. When the first of them for a recipient falls due, every pending
+message of that kind to that recipient goes out as a single digest, so a
+burst of new followers is one email rather than dozens.
+
+A sender first claims its batch with an UPDATE that only matches rows
+no one else holds, leasing them for RECORDBIN_OUTBOX_LEASE seconds, so
+any number of senders can share a database. A sender that dies leaves
+its rows to be picked up again once the lease runs out.
+
+Failed sends are retried with exponential backoff up to
+RECORDBIN_OUTBOX_MAX_ATTEMPTS times. A follow notification whose follow
+was undone before it went out is dropped.
+"""
+import json
+import smtplib
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_mail import Message, BadHeaderError
+from . import db, mail
+from .models import OutboxMessage, Follow
+
+
+def _follow_digest(contexts):
+	followers = OrderedDict()
+	for context in contexts:
+		followers[context['follower']['username']] = context['follower']
+	followers = list(followers.values())
+	if len(followers) == 1:
+		subject = '{} is now following you'.format(followers[0]['username'])
+	else:
+		subject = '{} people are now following you'.format(len(followers))
+	return subject, dict(username=contexts[-1]['username'], followers=followers)
+
+
+def _follow_exists(context):
+	return Follow.query.filter_by(
+		follower_id=context['follower']['id'], followed_id=context['user_id']).first() is not None
+
+
+# kind -> function of the pending messages' contexts returning (subject, context)
+DIGESTS = {
+	'followed_by': _follow_digest
+}
+# kind -> function of a message's context telling whether it is still worth sending
+STILL_CURRENT = {
+	'followed_by': _follow_exists
+}
+TEMPLATES = {
+	'followed_by': 'auth/email/followed_by'
+}
+
+
+def queue_email(to, kind, subject=None, template=None, **context):
+	"""Add a message to the outbox in the current transaction"""
+	now = datetime.utcnow()
+	send_after = now
+	if kind in DIGESTS:
+		send_after += timedelta(seconds=current_app.config['RECORDBIN_OUTBOX_DIGEST_WINDOW'])
+	message = OutboxMessage(
+		recipient=to, kind=kind, subject=subject, template=template or TEMPLATES.get(kind),
+		context=json.dumps(context), created=now, send_after=send_after)
+	db.session.add(message)
+	return message
+
+
+def _claim(token, now, batch_size):
+	"""Lease up to `batch_size` due messages to sender `token`; returns the rows it got
+
+	The UPDATEs only match rows without an unexpired lease and are
+	re-evaluated against rows a concurrent sender has just changed, so two
+	senders never take the same row.
+	"""
+	config = current_app.config
+	lease = {
+		OutboxMessage.claimed_by: token,
+		OutboxMessage.send_after: now + timedelta(seconds=config['RECORDBIN_OUTBOX_LEASE'])}
+	pending = OutboxMessage.query.filter(
+		OutboxMessage.sent == None, OutboxMessage.attempts < config['RECORDBIN_OUTBOX_MAX_ATTEMPTS'])
+
+	due = [row_id for row_id, in pending.filter(OutboxMessage.send_after <= now)
+		.order_by(OutboxMessage.send_after, OutboxMessage.id)
+		.with_entities(OutboxMessage.id).limit(batch_size)]
+	if not due:
+		return []
+	pending.filter(OutboxMessage.id.in_(due), OutboxMessage.send_after <= now) \
+		.update(lease, synchronize_session=False)
+
+	# Take the rest of each digest's window along, even the ones not yet due
+	digests = pending.filter(
+		OutboxMessage.claimed_by == token, OutboxMessage.kind.in_(list(DIGESTS))) \
+		.with_entities(OutboxMessage.recipient, OutboxMessage.kind).distinct().all()
+	for recipient, kind in digests:
+		pending.filter(
+			OutboxMessage.recipient == recipient, OutboxMessage.kind == kind,
+			db.or_(OutboxMessage.claimed_by == None, OutboxMessage.send_after <= now)) \
+			.update(lease, synchronize_session=False)
+	db.session.commit()
+	return OutboxMessage.query.filter_by(claimed_by=token, sent=None) \
+		.order_by(OutboxMessage.id).all()
+
+
+def _groups(rows):
+	"""Lists of rows that go out as one email each, digest kinds coalesced"""
+	groups = OrderedDict()
+	for row in rows:
+		key = (row.recipient, row.kind) if row.kind in DIGESTS else row.id
+		groups.setdefault(key, []).append(row)
+	return groups.values()
+
+
+def _current(group):
+	"""The rows of `group` still worth sending; the others are deleted"""
+	check = STILL_CURRENT.get(group[0].kind)
+	if check is None:
+		return group
+	current = []
+	for row in group:
+		if check(json.loads(row.context)):
+			current.append(row)
+		else:
+			db.session.delete(row)
+	return current
+
+
+def _render(group):
+	app = current_app
+	first = group[0]
+	contexts = [json.loads(row.context) for row in group]
+	if first.kind in DIGESTS:
+		subject, context = DIGESTS[first.kind](contexts)
+	else:
+		subject, context = first.subject, contexts[0]
+
+	msg = Message(app.config['RECORDBIN_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
+		sender=app.config['RECORDBIN_MAIL_SENDER'], recipients=[first.recipient])
+	if first.template is None:
+		msg.body, msg.html = context['body'], context['html']
+		return msg
+	# Straight from the environment: there is no request to feed context processors
+	msg.body = app.jinja_env.get_template(first.template + '.txt').render(**context)
+	msg.html = app.jinja_env.get_template(first.template + '.html').render(**context)
+	return msg
+
+
+def _failed(group, error, now, permanent=False):
+	config = current_app.config
+	for row in group:
+		row.attempts = config['RECORDBIN_OUTBOX_MAX_ATTEMPTS'] if permanent else row.attempts + 1
+		row.error = str(error)
+		row.claimed_by = None
+		row.send_after = now + timedelta(
+			seconds=config['RECORDBIN_OUTBOX_BACKOFF'] * 2 ** (row.attempts - 1))
+	current_app.logger.error('mail to %s failed: %s', group[0].recipient, error)
+
+
+def drain(batch_size=100, now=None):
+	"""Send up to `batch_size` due messages; returns the number of emails sent
+
+	Each email is committed as sent right after it goes out, so a crash
+	repeats at most the one in flight, once the lease runs out.
+	"""
+	now = now or datetime.utcnow()
+	token = uuid.uuid4().hex
+	rows = _claim(token, now, batch_size)
+	if not rows:
+		return 0
+
+	sent = 0
+	try:
+		with mail.connect() as connection:
+			for group in _groups(rows):
+				group = _current(group)
+				if not group:
+					db.session.commit()
+					continue
+				try:
+					msg = _render(group)
+				except Exception as e:
+					current_app.logger.exception('cannot render outbox message %d', group[0].id)
+					_failed(group, e, now, permanent=True)
+					db.session.commit()
+					continue
+				try:
+					connection.send(msg)
+				except (smtplib.SMTPRecipientsRefused, BadHeaderError, AssertionError) as e:
+					_failed(group, e, now, permanent=True)
+				except smtplib.SMTPResponseException as e:
+					_failed(group, e, now, permanent=e.smtp_code >= 500)
+				except (smtplib.SMTPException, socket.error) as e:
+					# The connection may be gone; leave the rest of the batch for the next round
+					_failed(group, e, now)
+					db.session.commit()
+					break
+				else:
+					for row in group:
+						row.sent = now
+					sent += 1
+				db.session.commit()
+	finally:
+		# Hand back what is left unsent, say with the SMTP server down, so
+		# it does not sit out the lease; drop any half-made change first
+		db.session.rollback()
+		OutboxMessage.query.filter_by(claimed_by=token, sent=None) \
+			.update({OutboxMessage.claimed_by: None, OutboxMessage.send_after: now},
+				synchronize_session=False)
+		db.session.commit()
+	return sent
+
+
+def prune(days):
+	"""Delete messages sent, or queued and given up on, more than `days` days ago"""
+	cutoff = datetime.utcnow() - timedelta(days=days)
+	given_up = db.and_(
+		OutboxMessage.sent == None, OutboxMessage.created < cutoff,
+		OutboxMessage.attempts >= current_app.config['RECORDBIN_OUTBOX_MAX_ATTEMPTS'])
+	deleted = OutboxMessage.query.filter(db.or_(OutboxMessage.sent < cutoff, given_up)) \
+		.delete(synchronize_session=False)
+	db.session.commit()
+	return deleted
+
+
+def run(batch_size=100, interval=5, keep_days=7):
+	"""Drain the outbox until interrupted, sleeping `interval` seconds when idle"""
+	last_prune = 0
+	while True:
+		try:
+			if time.time() - last_prune > 60 * 60:
+				prune(keep_days)
+				last_prune = time.time()
+			sent = drain(batch_size)
+		except Exception:
+			db.session.rollback()
+			current_app.logger.exception('outbox drain failed')
+			sent = 0
+		finally:
+			db.session.remove()
+		if sent < batch_size:
+			time.sleep(interval)
@@ -0,0 +1,120 @@
+"""Write-behind buffering of User.last_seen
+
+Recording a visit on every request used to cost an UPDATE and a commit on
+users_table. LastSeenBuffer instead keeps the newest visit per user in
+memory, records a user at most once per RECORDBIN_LAST_SEEN_WINDOW
+seconds, and writes everything pending in a single bulk UPDATE. Flushes
+happen at request teardown once half a window has passed, and from a
+background thread so quiet workers still deliver within the window.
+"""
+import atexit
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from . import db
+
+
+class LastSeenBuffer(object):
+
+	def __init__(self, app=None):
+		self._lock = threading.Lock()
+		self._pending = {}
+		self._recorded = {}
+		self._last_flush = time.time()
+		self._thread = None
+		self.app = None
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		self.window = app.config['RECORDBIN_LAST_SEEN_WINDOW']
+		app.extensions['last_seen'] = self
+		app.teardown_request(self._teardown)
+
+	def touch(self, user_id, now=None):
+		"""Note a visit; returns True if it was buffered, False if throttled"""
+		now = now or time.time()
+		with self._lock:
+			if now - self._recorded.get(user_id, 0) < self.window:
+				return False
+			self._recorded[user_id] = now
+			self._pending[user_id] = datetime.utcfromtimestamp(now)
+		self._start_flusher()
+		return True
+
+	def flush(self):
+		"""Write every pending last_seen in one UPDATE; returns the row count"""
+		with self._lock:
+			pending, self._pending = self._pending, {}
+			self._last_flush = now = time.time()
+			# Forget users whose window has passed; they are free to record again
+			self._recorded = dict(
+				(user_id, seen) for user_id, seen in self._recorded.items()
+				if now - seen < self.window)
+		if not pending:
+			return 0
+
+		from .models import User, Stamp
+		users = User.__table__
+		try:
+			shown = dict(db.session.query(User.id, User.last_seen)
+				.filter(User.id.in_(pending.keys())))
+			db.session.execute(
+				users.update()
+				.where(users.c.id.in_(pending.keys()))
+				.values(last_seen=db.case(pending, value=users.c.id)))
+			# The user directory shows the day of last_seen
+			if any(shown.get(user_id) is None or shown[user_id].date() != seen.date()
+					for user_id, seen in pending.items()):
+				Stamp.touch('users')
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			with self._lock:
+				for user_id, seen in pending.items():
+					self._pending.setdefault(user_id, seen)
+			raise
+		return len(pending)
+
+	def due(self):
+		return bool(self._pending) and time.time() - self._last_flush >= self.window / 2.0
+
+	def _teardown(self, exc):
+		if exc is None and self.due():
+			try:
+				self.flush()
+			except Exception:
+				self.app.logger.exception('last_seen flush failed')
+
+	def _start_flusher(self):
+		if self._thread is not None or not self.app.config['RECORDBIN_LAST_SEEN_FLUSHER']:
+			return
+		with self._lock:
+			if self._thread is not None:
+				return
+			self._thread = threading.Thread(target=self._run_flusher, name='last-seen-flusher')
+			self._thread.daemon = True
+			self._thread.start()
+		atexit.register(self._flush_in_context)
+
+	def _run_flusher(self):
+		while True:
+			time.sleep(self.window / 2.0)
+			try:
+				self._flush_in_context()
+			except Exception:
+				self.app.logger.exception('last_seen flush failed')
+
+	def _flush_in_context(self):
+		with self.app.app_context():
+			try:
+				self.flush()
+			finally:
+				db.session.remove()
+
+
+def touch(user_id):
+	"""Buffer a visit by `user_id` against the current app"""
+	return current_app.extensions['last_seen'].touch(user_id)
@@ -0,0 +1,166 @@
+"""Full-text search over record collections
+
+Each title gets one row in a `title_search` side table holding its artist
+name, title, color, notes and year. On SQLite that table is an FTS5 index;
+on PostgreSQL it holds a tsvector behind a GIN index. Rows are refreshed
+from Title mapper events, so every write path (add, edit, delete) keeps the
+index in step inside its own transaction. Other databases fall back to
+LIKE matching against titles directly.
+"""
+import re
+from sqlalchemy import event, MetaData, Table, Column, Integer
+from sqlalchemy.dialects import postgresql
+from . import db
+from .models import Title, Artist
+
+# Kept out of db.metadata: create_all must not build these as plain tables
+fts_index = Table(
+	'title_search', MetaData(),
+	Column('rowid', Integer),
+	Column('owner_id', Integer))
+
+tsvector_index = Table(
+	'title_search', MetaData(),
+	Column('title_id', Integer, primary_key=True),
+	Column('owner_id', Integer),
+	Column('document', postgresql.TSVECTOR))
+
+_SQLITE_CREATE = [
+	"CREATE VIRTUAL TABLE IF NOT EXISTS title_search USING fts5("
+	"artist, title, color, notes, year, owner_id UNINDEXED, "
+	"prefix='2 3', tokenize='unicode61 remove_diacritics 1')"]
+
+_POSTGRES_CREATE = [
+	"CREATE TABLE IF NOT EXISTS title_search ("
+	"title_id integer PRIMARY KEY REFERENCES titles(id) ON DELETE CASCADE, "
+	"owner_id integer NOT NULL, document tsvector NOT NULL)",
+	"CREATE INDEX IF NOT EXISTS ix_title_search_document "
+	"ON title_search USING gin(document)",
+	"CREATE INDEX IF NOT EXISTS ix_title_search_owner_id ON title_search (owner_id)"]
+
+_SQLITE_FILL = (
+	"INSERT INTO title_search (rowid, artist, title, color, notes, year, owner_id) "
+	"SELECT t.id, a.name, t.name, t.color, t.notes, t.year, t.owner_id "
+	"FROM titles t JOIN artists a ON a.id = t.artist_id")
+
+_POSTGRES_FILL = (
+	"INSERT INTO title_search (title_id, owner_id, document) "
+	"SELECT t.id, t.owner_id, to_tsvector('simple', "
+	"concat_ws(' ', a.name, t.name, t.color, t.notes, t.year::text)) "
+	"FROM titles t JOIN artists a ON a.id = t.artist_id")
+
+_STATEMENTS = {
+	'sqlite': {
+		'create': _SQLITE_CREATE,
+		'drop': "DROP TABLE IF EXISTS title_search",
+		'fill': _SQLITE_FILL,
+		'fill_one': _SQLITE_FILL + " WHERE t.id = :id",
+		'clear': "DELETE FROM title_search",
+		'clear_one': "DELETE FROM title_search WHERE rowid = :id",
+		'fill_after': _SQLITE_FILL + " WHERE t.owner_id = :owner_id AND t.id > :id",
+		'clear_after': "DELETE FROM title_search WHERE owner_id = :owner_id AND rowid > :id"},
+	'postgresql': {
+		'create': _POSTGRES_CREATE,
+		'drop': "DROP TABLE IF EXISTS title_search",
+		'fill': _POSTGRES_FILL,
+		'fill_one': _POSTGRES_FILL + " WHERE t.id = :id",
+		'clear': "DELETE FROM title_search",
+		'clear_one': "DELETE FROM title_search WHERE title_id = :id",
+		'fill_after': _POSTGRES_FILL + " WHERE t.owner_id = :owner_id AND t.id > :id",
+		'clear_after': "DELETE FROM title_search WHERE owner_id = :owner_id AND title_id > :id"}
+}
+
+
+def _statements(bind):
+	return _STATEMENTS.get(bind.dialect.name)
+
+
+def search_terms(query):
+	"""Split user input into the word tokens both index backends agree on"""
+	return re.findall(r'\w+', query or '', re.UNICODE)[:8]
+
+
+def matching_ids(user, query):
+	"""Select of the ids of `user`'s titles matching every term in `query`
+
+	Each term is matched as a prefix, so results update as the user types.
+	"""
+	terms = search_terms(query)
+	dialect = db.engine.dialect.name
+
+	if dialect == 'sqlite':
+		match = ' '.join(u'"{}"*'.format(term) for term in terms)
+		return db.select([fts_index.c.rowid]) \
+			.where(db.literal_column('title_search').op('MATCH')(match)) \
+			.where(fts_index.c.owner_id == user.id)
+
+	if dialect == 'postgresql':
+		match = ' & '.join(u'{}:*'.format(term) for term in terms)
+		return db.select([tsvector_index.c.title_id]) \
+			.where(tsvector_index.c.document.op('@@')(db.func.to_tsquery('simple', match))) \
+			.where(tsvector_index.c.owner_id == user.id)
+
+	select = db.select([Title.id]) \
+		.select_from(Title.__table__.join(Artist.__table__, Artist.id == Title.artist_id)) \
+		.where(Title.owner_id == user.id)
+	for term in terms:
+		pattern = u'%{}%'.format(term.lower())
+		select = select.where(db.or_(*[
+			db.func.lower(db.cast(column, db.String)).like(pattern)
+			for column in (Artist.name, Title.name, Title.color, Title.notes, Title.year)]))
+	return select
+
+
+def rebuild_index():
+	"""Create the index if it is missing and refill it from titles"""
+	statements = _statements(db.engine)
+	if statements is None:
+		return
+	for statement in statements['create']:
+		db.session.execute(statement)
+	db.session.execute(statements['clear'])
+	db.session.execute(statements['fill'])
+	db.session.commit()
+
+
+def index_titles_after(owner_id, title_id):
+	"""Index `owner_id`'s titles with ids above `title_id`, for inserts that skip the mapper"""
+	statements = _statements(db.engine)
+	if statements is None:
+		return
+	params = {'owner_id': owner_id, 'id': title_id}
+	db.session.execute(db.text(statements['clear_after']), params)
+	db.session.execute(db.text(statements['fill_after']), params)
+
+
+def _create_index(target, connection, **kw):
+	statements = _statements(connection)
+	if statements is not None:
+		for statement in statements['create']:
+			connection.execute(statement)
+
+
+def _drop_index(target, connection, **kw):
+	statements = _statements(connection)
+	if statements is not None:
+		connection.execute(statements['drop'])
+
+
+def _refresh_title(mapper, connection, target):
+	statements = _statements(connection)
+	if statements is not None:
+		connection.execute(db.text(statements['clear_one']), id=target.id)
+		connection.execute(db.text(statements['fill_one']), id=target.id)
+
+
+def _remove_title(mapper, connection, target):
+	statements = _statements(connection)
+	if statements is not None:
+		connection.execute(db.text(statements['clear_one']), id=target.id)
+
+
+event.listen(Title.__table__, 'after_create', _create_index)
+event.listen(Title.__table__, 'before_drop', _drop_index)
+event.listen(Title, 'after_insert', _refresh_title)
+event.listen(Title, 'after_update', _refresh_title)
+event.listen(Title, 'after_delete', _remove_title)
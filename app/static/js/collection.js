@@ -0,0 +1,97 @@
+// Only the first page of a collection is rendered server side. Every table
+// holding more rows carries a data-cursor; its next page is fetched from
+// /<username>/records once the end of the table scrolls into view. Search
+// results (search.js) page the same way, with their query in data-query.
+var $records = $('#records');
+var recordsOwner = $records.data('owner');
+var recordsEditable = $records.data('editable') == 1;
+
+function keepAllCell(width, text) {
+	return $('<td class="keep-all"></td>').css('width', width).text(text === null ? "" : text);
+}
+
+// Mirrors a row of macro/render_record_table.html
+function recordRow(record) {
+	var $row = $('<tr></tr>').attr('data-size-id', record.size_id);
+
+	keepAllCell("20%", record.artist).attr('id', record.id).appendTo($row);
+	keepAllCell("20%", record.title).appendTo($row);
+
+	var $photo = $('<td></td>').css('width', "5%").appendTo($row);
+	if (record.image) {
+		$('<a data-toggle="lightbox"></a>')
+			.attr('href', record.image)
+			.attr('data-title', record.artist + ' - ' + record.title)
+			.append('<span class="glyphicon glyphicon-camera pointer"></span>')
+			.appendTo($photo);
+	}
+
+	keepAllCell("10%", record.color).appendTo($row);
+	keepAllCell("5%", record.year).appendTo($row);
+	keepAllCell("15%", record.notes).appendTo($row);
+	keepAllCell("10%", record.added).appendTo($row);
+	$('<td style="display:none"></td>').attr('value', record.image || "").appendTo($row);
+
+	if (recordsEditable) {
+		$row.append('<td><span class="glyphicon glyphicon-pencil pointer" aria-hidden="true" data-toggle="modal" data-target=".edit-modal"></span></td>');
+	}
+	return $row;
+}
+
+function loadMoreRecords($table) {
+	var cursor = $table.attr('data-cursor');
+
+	if (!cursor || $table.data('loading')) {
+		return;
+	}
+	$table.data('loading', true);
+
+	$.ajax({
+		url: "/" + recordsOwner + "/records",
+		dataType: "json",
+		type: "GET",
+		data: {
+			size: $table.data('size-id'),
+			format: $table.data('format-id'),
+			mail: $table.data('mail'),
+			q: $table.attr('data-query'),
+			after: cursor
+		},
+
+		success: function(data) {
+			var $body = $table.find('tbody');
+
+			for (var i = 0; i < data.records.length; i++) {
+				$body.append(recordRow(data.records[i]));
+			}
+
+			if (data.next) {
+				$table.attr('data-cursor', data.next);
+			} else {
+				$table.removeAttr('data-cursor');
+			}
+			$table.data('loading', false);
+
+			// Keep going while the table end is still on screen
+			loadVisibleRecords();
+		},
+
+		error: function() {
+			$table.data('loading', false);
+		}
+	});
+}
+
+function loadVisibleRecords() {
+	var bottom = $(window).scrollTop() + $(window).height() + 600;
+
+	$('table[data-cursor]:visible').each(function() {
+		var $table = $(this);
+		if ($table.offset().top + $table.outerHeight() < bottom) {
+			loadMoreRecords($table);
+		}
+	});
+}
+
+$(window).on('scroll resize', _.throttle(loadVisibleRecords, 200));
+loadVisibleRecords();
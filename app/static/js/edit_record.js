@@ -1,5 +1,3 @@
-var editPencils = $("span[data-target='.edit-modal']");
-
 var parentRow;
 var record_dimensions;
 var tableId;
@@ -7,8 +5,8 @@ var recordId;
 var trashcan = $('h4.modal-title > a');
 
 
-// Autofill the form
-editPencils.on("click", function(){
+// Autofill the form; delegated so rows loaded later by collection.js work too
+$(document).on("click", "span[data-target='.edit-modal']", function(){
 
 	// Clear upload thumbnail
 	$("#edit_gallery").css("background-image", "none");
@@ -50,16 +48,10 @@ editPencils.on("click", function(){
 		mailInput.prop("checked", true);
 	}
 
-	if (tableId.indexOf("seven") > -1) {
-		// sizeInput.val("1");
-		document.querySelector('select[name="edit_size"] option[value="1"]').setAttribute('selected', "selected");
-	} else if (tableId.indexOf("ten") > -1) {
-		// sizeInput.val("2");
-		document.querySelector('select[name="edit_size"] option[value="2"]').setAttribute('selected', "selected");
-	} else if (tableId.indexOf("twelve") > -1) {
-		// sizeInput.val("3");
-		document.querySelector('select[name="edit_size"] option[value="3"]').setAttribute('selected', "selected");
-	}
+	// Size comes from the row (search results) or the table it is listed in
+	var sizeId = parentRow.data("size-id") || $(this).closest("table").data("size-id");
+	$('select[name="edit_size"] option').removeAttr('selected');
+	$('select[name="edit_size"] option[value="' + sizeId + '"]').attr('selected', "selected");
 
 	// Load the image
 	if (imageURL) {
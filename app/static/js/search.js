@@ -1,58 +1,77 @@
+// Filtering runs server side against the full-text index, so it covers the
+// whole collection and not only the rows collection.js has loaded so far.
+// Result pages stream into #search_table through the same cursor paging.
+var $searchResults = $("#search_results");
+var $searchTable = $searchResults.find("table");
+var searchRequest = null;
 
-function searchFunction() {
-
-// Declare variables 
-var input, filter, tables, td, i;
-input = document.getElementById("search");
-filter = input.value.toUpperCase();
-var tr = document.querySelectorAll("tr")
-var resultsElement = document.getElementById("results");
-var visible = 0;
-
-
-	// Hide/show results 
-  for (i = 0; i < tr.length; i++) {
-    artist_td = tr[i].getElementsByTagName("td")[0];
-    title_td = tr[i].getElementsByTagName("td")[1];
-    color_td = tr[i].getElementsByTagName("td")[3];
-    year_td = tr[i].getElementsByTagName("td")[4];
-
-    if (artist_td || title_td) {
-      if (artist_td.innerHTML.toUpperCase().indexOf(filter) > -1 || 
-        title_td.innerHTML.toUpperCase().indexOf(filter) > -1 ||
-        color_td.innerHTML.toUpperCase().indexOf(filter) > -1 ||
-        year_td.innerHTML.toString().indexOf(filter) > -1) {
-        
-      	var parentTable = tr[i].closest(".panel-default")
-      	var inMailTable = tr[i].closest("#mail"); //null
-
-        if (parentTable.style.display != "none" && inMailTable == null) {
-        	tr[i].style.display = "";
-        	resultsElement.style.display = "";
-        	visible += 1
-        }
-        
-      } else {
-        tr[i].style.display = "none";
-      }
-    } 
-  }
+function showSearchCount(count, more) {
+  var noun = count != 1 || more ? "Records" : "Record";
+  $("#results").text(count.toString() + (more ? "+ " : " ") + noun).show();
+}
+
+function runSearch() {
+  var query = $.trim($("#search").val());
 
-  var noun = visible != 1 ? "Records" : "Record"
-  resultsElement.innerHTML = visible.toString() + " " + noun;
+  if (searchRequest) {
+    searchRequest.abort();
+    searchRequest = null;
+  }
 
-  if (input.value.length == 0) {
-  	resultsElement.style.display = "none";
+  if (query.length == 0) {
+    clearSearch();
+    return;
   }
+
+  var sizeId = $("#sizes li.active").data("size-id") || "";
+
+  searchRequest = $.ajax({
+    url: "/" + recordsOwner + "/records",
+    dataType: "json",
+    type: "GET",
+    data: { q: query, mail: 0, size: sizeId },
+
+    success: function(data) {
+      var $body = $searchTable.find("tbody").empty();
+
+      for (var i = 0; i < data.records.length; i++) {
+        $body.append(recordRow(data.records[i]));
+      }
+
+      $searchTable.attr("data-query", query);
+      $searchTable.data("size-id", sizeId);
+      if (data.next) {
+        $searchTable.attr("data-cursor", data.next);
+      } else {
+        $searchTable.removeAttr("data-cursor");
+      }
+
+      $searchResults.find(".badge").text(data.records.length + (data.next ? "+" : ""));
+      showSearchCount(data.records.length, !!data.next);
+      $records.hide();
+      $searchResults.show();
+      searchRequest = null;
+      loadVisibleRecords();
+    }
+  });
 }
 
-$("#searchClear").on("click", function () {
-	$("#search").val("");
-	$("#results").hide();
+var searchFunction = _.debounce(runSearch, 250);
 
-	allRows = document.querySelectorAll("tr");
+function clearSearch() {
+  $("#search").val("");
+  $("#results").hide();
+  $searchResults.hide();
+  $searchTable.find("tbody").empty();
+  $searchTable.removeAttr("data-cursor").removeAttr("data-query");
+  $records.show();
+}
 
-	for (var i = allRows.length - 1; i >= 0; i--) {
-		allRows[i].style.display = "";
-	}
-})
\ No newline at end of file
+$("#searchClear").on("click", function () {
+  if (searchRequest) {
+    searchRequest.abort();
+    searchRequest = null;
+  }
+  clearSearch();
+  loadVisibleRecords();
+})
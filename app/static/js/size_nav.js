@@ -1,9 +1,11 @@
-var $seven = $('#seven_inches');
-var $ten = $('#ten_inches');
-var $twelve = $('#twelve_inches');
 var $mail = $('#mail');
 var $searchDiv = $($("#search").parents()[0]);
 
+// Every in-hand size table, keyed off the data-size its table carries
+function sizePanels() {
+	return $('table[data-size]').closest('.panel').not($mail.find('.panel'));
+}
+
 
 $('#sizes li').on('click', function(){
 
@@ -14,60 +16,38 @@ $('#sizes li').on('click', function(){
 	});
 
 
-	// Clear the search box && show all rows
-	$("#search").val("");
-	$("#results").hide();
-
-	allRows = document.querySelectorAll("tr");
-
-	for (var i = allRows.length - 1; i >= 0; i--) {
-		allRows[i].style.display = "";
-	}
+	// Clear the search box && show the collection again
+	clearSearch();
  
  	// Active Class Navigator
 	if  ( $(this).hasClass('active') != true) {
 		$(this).toggleClass('active');	
 	}
 
-	switch ( $(this).text() ) {
-		case "7 Inches":
-			$ten.hide();
-			$twelve.hide();
-			$mail.hide();
-			$seven.show();
-			$searchDiv.show();
-			break;
+	var size = String($(this).data('size'));
 
-		case "10 Inches":
-			$seven.hide();
-			$twelve.hide();
-			$mail.hide();
-			$ten.show();
-			$searchDiv.show();
-			break;
+	switch ( size ) {
+		case "mail":
+			sizePanels().hide();
+	 		$mail.show();
+	 		$searchDiv.hide();
+			break;	
 
-		case "12 Inches":
-			$seven.hide();
-			$ten.hide();
+		case "all":
 			$mail.hide();
-			$twelve.show();
+			sizePanels().show();
 			$searchDiv.show();
 			break;
 
-		case "Incoming":
-			$seven.hide();
-	  		$ten.hide();
-	  		$twelve.hide();
-	 		$mail.show();
-	 		$searchDiv.hide();
-			break;	
-
 		default:
 			$mail.hide();
-			$seven.show();
-			$ten.show();
-			$twelve.show();
+			sizePanels().each(function() {
+				$(this).toggle(String($(this).find('table').data('size')) === size);
+			});
 			$searchDiv.show();
 			break;
 	}
-})
\ No newline at end of file
+
+	// Newly shown tables may need their next page
+	loadVisibleRecords();
+})
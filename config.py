@@ -15,6 +15,48 @@ class Config:
 	RECORDBIN_MAIL_SUBJECT_PREFIX = '[RecordBin]'
 	RECORDBIN_MAIL_SENDER = os.environ.get('RECORDBIN_MAIL_SENDER')
 	RECORDBIN_ADMIN = 'RecordBin Admin <app57807167@heroku.com>'
+	# All mail goes through the outbox table; see app/outbox.py
+	RECORDBIN_OUTBOX_DIGEST_WINDOW = 15 * 60
+	RECORDBIN_OUTBOX_BATCH_SIZE = 100
+	RECORDBIN_OUTBOX_MAX_ATTEMPTS = 5
+	RECORDBIN_OUTBOX_BACKOFF = 60
+	# Seconds a sender holds the messages it took before another may retry them
+	RECORDBIN_OUTBOX_LEASE = 10 * 60
+	RECORDBIN_OUTBOX_POLL_INTERVAL = 5
+	RECORDBIN_OUTBOX_KEEP_DAYS = 7
+	RECORDBIN_RECORDS_PER_PAGE = 100
+	RECORDBIN_FEED_BACKFILL = 50
+	# Push feed updates over SSE / long-poll; needs threaded or async workers
+	RECORDBIN_FEED_STREAMING = os.environ.get('RECORDBIN_FEED_STREAMING') == '1'
+	RECORDBIN_FEED_STREAM_TIMEOUT = 300
+	RECORDBIN_FEED_WAIT_TIMEOUT = 25
+	RECORDBIN_FEED_KEEPALIVE = 15
+	# last_seen is written at most once a window per user, in batches
+	RECORDBIN_LAST_SEEN_WINDOW = 60
+	RECORDBIN_LAST_SEEN_FLUSHER = True
+	# Per-worker cache of logged-in users and role permissions
+	RECORDBIN_IDENTITY_CACHE_SIZE = 1024
+	RECORDBIN_IDENTITY_CACHE_TTL = 60
+	RECORDBIN_ARTIST_CACHE_SIZE = 4096
+	RECORDBIN_ARTIST_CACHE_TTL = 3600
+	RECORDBIN_IMPORT_CHUNK_SIZE = 500
+	RECORDBIN_IMPORT_MAX_ERRORS = 100
+	# Rendered record tables; see app/fragments.py for sharing them between workers
+	RECORDBIN_FRAGMENT_CACHE_BACKEND = os.environ.get('RECORDBIN_FRAGMENT_CACHE_BACKEND')
+	RECORDBIN_FRAGMENT_CACHE_OPTIONS = {}
+	RECORDBIN_FRAGMENT_CACHE_PREFIX = 'recordbin:'
+	RECORDBIN_FRAGMENT_CACHE_SIZE = 256
+	RECORDBIN_FRAGMENT_CACHE_TTL = 60 * 60
+	# Responses, exports included, are gzipped for clients that accept it;
+	# level 0 turns it off except for .tar.gz archives, which are gzip anyway
+	RECORDBIN_GZIP_LEVEL = 6
+	RECORDBIN_GZIP_MIN_SIZE = 1024
+	# Output of `manage.py assets build`
+	RECORDBIN_ASSET_DIR = os.path.join(base_dir, 'app', 'static', 'dist')
+	# Serve the built bundles instead of the sources; the manifest must exist
+	RECORDBIN_ASSETS_BUILT = False
+	# Part of every page ETag; set per deploy so cached pages don't outlive a release
+	RECORDBIN_RELEASE = os.environ.get('RECORDBIN_RELEASE', '')
 
 	@staticmethod
 	def init_app(app):
@@ -29,12 +71,14 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
 	TESTING = True
+	RECORDBIN_LAST_SEEN_FLUSHER = False
 	SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(base_dir, 'data-test.sqlite')
 
 
 class ProductionConfig(Config):
 	SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
 		'sqlite:///' + os.path.join(base_dir, 'data.sqlite')
+	RECORDBIN_ASSETS_BUILT = os.environ.get('RECORDBIN_ASSETS_BUILT') != '0'
 
 	@classmethod
 	def init_app(cls, app):
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import os
 from app import create_app, db
-from app.models import User, Follow, Role, Title, Artist, Permission, Size, Format, user_local_time, Image
+from app.models import (
+	User, Follow, Role, Title, Artist, Permission, Size, Format, user_local_time, Image,
+	FeedItem)
+from app.search import rebuild_index
+from app import imports
 from flask_script import Manager
 from flask_script import Shell
 from flask.ext.migrate import Migrate, MigrateCommand
@@ -32,10 +36,14 @@ def make_shell_context():
 		app=app, db=db, User=User,
 		Role=Role, Artist=Artist, Title=Title,
 		Permission=Permission, Follow=Follow, Size=Size,
-		Format=Format, user_local_time=user_local_time, Image=Image)
+		Format=Format, user_local_time=user_local_time, Image=Image,
+		FeedItem=FeedItem)
+
+assets = Manager(usage='Build static asset bundles')
 
 manager.add_command('shell', Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
+manager.add_command('assets', assets)
 
 
 @manager.command
@@ -66,7 +74,7 @@ def test(coverage=False):
 def deploy():
 	"""Run Deployment tasks"""
 	from flask_migrate import upgrade
-	from app.models import Role, User, Size, Format
+	from app.models import Role, User, Size, Format, Stamp
 
 	# migrate database to latest revision
 	upgrade()
@@ -74,14 +82,115 @@ def deploy():
 	# create user roles
 	Role.insert_roles()
 
+	# version stamps for page ETags
+	Stamp.insert_stamps()
+
 	# create self-follows for all users
 	User.add_self_follows()
 
+	# hash emails for avatars of users that predate avatar_hash
+	User.fill_avatar_hashes()
+
 	Format.insert_formats()
 
 	Size.insert_sizes()
 
+	# backfill denormalized counters
+	User.rebuild_counters()
+
+	# build the full-text index if this database predates it
+	rebuild_index()
+
+	# fill activity feeds from existing follows
+	FeedItem.rebuild(app.config['RECORDBIN_FEED_BACKFILL'])
+
+	# key existing titles for the duplicate check
+	Title.rebuild_content_keys()
+
 	db.session.commit()
 
+
+@manager.command
+def rebuild_counters(check=False):
+	"""Rebuild denormalized user counters (--check only reports drift)"""
+	if not check:
+		User.rebuild_counters()
+
+	drifted = User.check_counters()
+	for username, counter, stored, actual in drifted:
+		print '{}: {} is {}, expected {}'.format(username, counter, stored, actual)
+	print '{} drifted counter(s)'.format(len(drifted))
+
+
+@manager.command
+def rebuild_feeds():
+	"""Backfill every activity feed from current follows"""
+	FeedItem.rebuild(app.config['RECORDBIN_FEED_BACKFILL'])
+	print '{} feed item(s)'.format(FeedItem.query.count())
+
+
+@manager.command
+def reindex_search():
+	"""Create and refill the full-text record search index"""
+	rebuild_index()
+	print 'Search index rebuilt'
+
+
+@manager.command
+def rebuild_content_keys():
+	"""Recompute the duplicate-check key of every title"""
+	duplicates = Title.rebuild_content_keys()
+	for title_id in duplicates:
+		print 'title {} duplicates an earlier title and was left unkeyed'.format(title_id)
+	print '{} duplicate title(s)'.format(len(duplicates))
+
+
+
+@manager.command
+def import_collection(username, path, chunk_size=None):
+	"""Import a CSV in the download layout into a user's collection"""
+	user = User.query.filter_by(username=username).first()
+	if user is None:
+		print 'No user named {}'.format(username)
+		return
+
+	def progress(result):
+		print '{} row(s) read, {} added, {} duplicate(s), {} error(s)'.format(
+			result.rows, result.added, result.duplicates, result.error_count)
+
+	chunk_size = int(chunk_size or app.config['RECORDBIN_IMPORT_CHUNK_SIZE'])
+	try:
+		with open(path, 'rb') as csv_file:
+			result = imports.import_collection(
+				user, csv_file, chunk_size, progress, max_errors=None)
+	except imports.CollectionImportError as e:
+		print 'Cannot import {}: {}'.format(path, e)
+		return
+	for line, message in result.errors:
+		print 'line {}: {}'.format(line, message)
+
+
+@manager.command
+def send_outbox(once=False):
+	"""Send queued email, or with --once, send one batch and exit"""
+	from app import outbox
+	batch_size = app.config['RECORDBIN_OUTBOX_BATCH_SIZE']
+	if once:
+		print '{} email(s) sent'.format(outbox.drain(batch_size))
+		return
+	outbox.run(
+		batch_size, app.config['RECORDBIN_OUTBOX_POLL_INTERVAL'],
+		app.config['RECORDBIN_OUTBOX_KEEP_DAYS'])
+
+
+@assets.command
+def build():
+	"""Compile, minify and fingerprint the static bundles"""
+	from app.assets import build as build_assets
+	manifest = build_assets(app.static_folder, app.config['RECORDBIN_ASSET_DIR'])
+	for name, filename in manifest.items():
+		print '{} -> {}'.format(name, filename)
+
+
 if __name__ == '__main__':
 	manager.run()
@@ -0,0 +1,85 @@
+import unittest
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from flask import render_template_string
+from app import create_app
+from app.assets import Assets, build, minify_js
+
+
+class AssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.out_dir = tempfile.mkdtemp()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.out_dir)
+
+    def test_minify_js_keeps_strings_and_regexes(self):
+        source = (
+            "// leading comment\n"
+            "var url = 'https://example.com/a'; /* block */\n"
+            "    var re = /[/']+\\//g;  // trailing\n"
+            "\n"
+            "var half = total / 2 / 1;\n")
+        self.assertEqual(minify_js(source), (
+            "var url = 'https://example.com/a';\n"
+            "var re = /[/']+\\//g;\n"
+            "var half = total / 2 / 1;\n"))
+
+    def test_build_writes_hashed_bundles_and_manifest(self):
+        manifest = build(self.app.static_folder, self.out_dir)
+        self.assertEqual(list(manifest), ['main.css', 'user.js'])
+        with open(os.path.join(self.out_dir, 'manifest.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+
+        path = os.path.join(self.out_dir, manifest['user.js'])
+        with open(path) as f:
+            script = f.read()
+        self.assertIn('function loadMoreRecords', script)
+        self.assertNotIn('// ', script)
+        with open(path + '.gz', 'rb') as f:
+            self.assertEqual(gzip.GzipFile(fileobj=StringIO(f.read())).read(), script)
+
+        # Same content, same names
+        self.assertEqual(build(self.app.static_folder, self.out_dir), manifest)
+
+    def test_built_assets_are_served_immutable(self):
+        with self.app.test_request_context():
+            self.assertEqual(
+                render_template_string("{{ asset_urls('main.css')[0] }}"), '/static/css/main.css')
+
+        manifest = build(self.app.static_folder, self.out_dir)
+        self.app.config['RECORDBIN_ASSET_DIR'] = self.out_dir
+        # A manifest on disk is not enough
+        Assets(self.app)
+        with self.app.test_request_context():
+            self.assertEqual(
+                render_template_string("{{ asset_urls('main.css')[0] }}"), '/static/css/main.css')
+
+        self.app.config['RECORDBIN_ASSETS_BUILT'] = True
+        Assets(self.app)
+        url = '/assets/' + manifest['main.css']
+        with self.app.test_request_context():
+            self.assertEqual(render_template_string("{{ asset_urls('main.css')[0] }}"), url)
+
+        client = self.app.test_client()
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        plain = client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('.nopadding', plain.data)
+        self.assertEqual(client.get('/assets/manifest.json').status_code, 404)
+
+    def test_built_assets_require_a_manifest(self):
+        self.app.config.update(RECORDBIN_ASSET_DIR=self.out_dir, RECORDBIN_ASSETS_BUILT=True)
+        with self.assertRaises(RuntimeError):
+            Assets(self.app)
@@ -2,6 +2,7 @@ import unittest
 from app import create_app, db
 from app.models import User, Role, Size, Format, Title, encode_id
 from flask import url_for
+import json
 import re
 
 
@@ -138,6 +139,14 @@ class FlaskClientTestCase(unittest.TestCase):
         response = self.add_record(username="profile_john", mail=0)
         assert "Black Sabbath - Master of Reality Added!" in response.data
 
+    def test_add_duplicate_record(self):
+        self.login(email="profile_john@example.com", password="yolo")
+        self.add_record(username="profile_john", mail=0)
+        response = self.add_record(username="profile_john", mail=1)
+        assert "You already own this" in response.data
+        self.assertEqual(Title.query.count(), 1)
+        self.assertEqual(User.query.filter_by(username="profile_john").first().records_count, 1)
+
     def test_add_record_as_different_user(self):
         self.login(email="profile_john@example.com", password="yolo")
         response = self.add_record(username="kgjkhgh", mail=0)
@@ -157,6 +166,172 @@ class FlaskClientTestCase(unittest.TestCase):
     # 	stripped_response = re.sub(r'\s+', '', response.data)
     # 	assert '<divid="twelve_inches"class="panelpanel-default"><!--Defaultpanelcontents--><divclass="panel-heading"><strong>12Inches</strong><spanclass="badgepull-right">1</span></' in stripped_response
 
+    # Collection API #
+    def test_collection_records_pages(self):
+        self.app.config['RECORDBIN_RECORDS_PER_PAGE'] = 1
+        self.login(email="profile_john@example.com", password="yolo")
+        self.add_record(username="profile_john", mail=0)
+        Title(
+            name="Vol. 4", artist_id=1, year=1972, format_id=1,
+            owner_id=1, mail=1, size_id=3).add_to_table()
+
+        response = self.client.get('/profile_john')
+        assert 'data-cursor="' in response.data
+
+        response = self.client.get('/profile_john/records')
+        data = json.loads(response.data)
+        assert len(data['records']) == 1
+        assert data['records'][0]['artist'] == 'Black Sabbath'
+
+        response = self.client.get('/profile_john/records?after=' + data['next'])
+        data = json.loads(response.data)
+        assert len(data['records']) == 1
+        assert data['records'][0]['mail'] == 1
+
+        response = self.client.get('/profile_john/records?mail=0&size=1')
+        assert json.loads(response.data) == {'records': [], 'next': None}
+
+    def test_record_tables_are_cached_per_version(self):
+        from app.fragments import fragment_cache
+        self.login(email="profile_john@example.com", password="yolo")
+        self.client.get('/profile_john')
+        self.client.get('/profile_john')
+        self.assertEqual(len(fragment_cache(self.app).backend), 1)
+
+        response = self.add_record(username="profile_john", mail=0)
+        assert "Master of Reality" in response.data
+        self.assertEqual(len(fragment_cache(self.app).backend), 2)
+
+        # Other viewers get their own rendering, without the edit column
+        self.logout()
+        response = self.client.get('/profile_john')
+        assert "Master of Reality" in response.data
+        assert 'data-editable="0"' in response.data
+        self.assertEqual(len(fragment_cache(self.app).backend), 3)
+
+    def test_profile_and_directory_answer_304(self):
+        response = self.client.get('/profile_john')
+        etag = response.headers['ETag']
+        self.assertNotIn('Last-Modified', response.headers)
+        response = self.client.get('/profile_john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        last_modified = self.client.get('/users').headers['Last-Modified']
+        response = self.client.get('/users', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # The gzip rendering has its own tag, which revalidates just the same
+        gzipped = self.client.get('/profile_john', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['ETag'], etag[:-1] + '-gzip"')
+        response = self.client.get('/profile_john', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': gzipped.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], gzipped.headers['ETag'])
+
+        # Logged in viewers get their own ETag and no Last-Modified
+        self.login(email="profile_john2@example.com", password="yolo")
+        response = self.client.get('/profile_john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response.headers)
+        self.logout()
+
+        # A new record moves the owner's collection version on
+        self.login(email="profile_john@example.com", password="yolo")
+        self.add_record(username="profile_john", mail=0)
+        self.logout()
+        response = self.client.get('/profile_john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        assert "Master of Reality" in response.data
+
+    def test_page_versions_move_only_with_what_pages_show(self):
+        from app.models import Stamp
+        john = User.query.filter_by(username='profile_john').first()
+        john2 = User.query.filter_by(username='profile_john2').first()
+        fan = User(email='fan@example.com', username='fan', password='yolo', confirmed=True)
+        db.session.add(fan)
+        db.session.commit()
+        fan.follow(john)
+
+        def versions():
+            db.session.expire_all()
+            return (Stamp.read('users')['users'][0],
+                    [user.profile_version for user in (john, john2, fan)])
+
+        before = versions()
+        # Same-day visits, follows and hidden fields leave every page alone
+        self.app.extensions['last_seen'].touch(john.id)
+        self.app.extensions['last_seen'].flush()
+        john2.follow(john)
+        john.about_me = 'Still the overlord'
+        db.session.commit()
+        self.assertEqual(versions(), before)
+
+        # A new name shows in the directory, on the fan's profile and on
+        # the profile of everyone the fan is listed on
+        fan.username = 'superfan'
+        db.session.commit()
+        users, profiles = versions()
+        self.assertEqual(users, before[0] + 1)
+        self.assertEqual(profiles, [before[1][0] + 1, before[1][1], before[1][2] + 1])
+
+        # A new location only shows on the user's own profile
+        john2.location = 'Birmingham'
+        db.session.commit()
+        self.assertEqual(versions(), (users, [profiles[0], profiles[1] + 1, profiles[2]]))
+
+    def test_collection_records_search(self):
+        self.login(email="profile_john@example.com", password="yolo")
+        self.add_record(username="profile_john", mail=0)
+
+        response = self.client.get('/profile_john/records?q=sabb+master')
+        data = json.loads(response.data)
+        assert [r['title'] for r in data['records']] == ['Master of Reality']
+
+        response = self.client.get('/profile_john/records?q=reality+purple')
+        assert json.loads(response.data)['records'] == []
+
+        response = self.client.get('/profile_john2/records?q=sabbath')
+        assert json.loads(response.data)['records'] == []
+
+    def test_collection_records_bad_cursor(self):
+        response = self.client.get('/profile_john/records?after=xyz')
+        assert response.status_code == 400
+
+    # Activity feed #
+    def test_follower_records_since_and_etag(self):
+        self.login(email="profile_john@example.com", password="yolo")
+        john = User.query.filter_by(username='profile_john').first()
+        john.follow(john)
+        self.add_record(username="profile_john")
+
+        response = self.client.get('/profile_john/follower_records')
+        feed = json.loads(response.data)
+        assert [item['title'] for item in feed] == ['Master of Reality']
+        assert feed[0]['user'] == 'you'
+
+        etag = response.headers['ETag']
+        response = self.client.get(
+            '/profile_john/follower_records', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == ''
+
+        since = feed[0]['cursor']
+        response = self.client.get('/profile_john/follower_records?since=' + since)
+        assert json.loads(response.data) == []
+
+        Title(
+            name="Vol. 4", artist_id=1, year=1972, format_id=1,
+            owner_id=john.id, mail=0, size_id=3).add_to_table()
+        response = self.client.get('/profile_john/follower_records?since=' + since)
+        assert [item['title'] for item in json.loads(response.data)] == ['Vol. 4']
+
+        response = self.client.get('/profile_john/follower_records?before=' + since)
+        assert json.loads(response.data) == []
+
+    def test_follower_records_bad_cursor(self):
+        self.login(email="profile_john@example.com", password="yolo")
+        response = self.client.get('/profile_john/follower_records?since=xyz')
+        assert response.status_code == 400
+
     # Delete a record #
     def test_delete_record(self):
         self.login(email="profile_john@example.com", password="yolo")
@@ -178,6 +353,21 @@ class FlaskClientTestCase(unittest.TestCase):
         response = self.delete_record(99)
         assert response.status_code == 404
 
+    def test_out_of_range_public_id_is_not_found(self):
+        from app.models import encode_ids
+        hashed_id = encode_ids([2 ** 63 + 5])[0]
+        self.login(email="profile_john@example.com", password="yolo")
+        self.add_record(username="profile_john")
+        response = self.client.get(url_for('main.delete_record', hashed_id=hashed_id))
+        assert response.status_code == 404
+        response = self.client.post(
+            url_for("main.user", username="profile_john"),
+            data=dict(
+                edit_id=hashed_id, edit_artist="Budgie", edit_title="Squawk",
+                edit_color="Black", edit_size=3, edit_year=1972))
+        assert response.status_code == 404
+        self.assertEqual(Title.query.first().name, "Master of Reality")
+
     # Edit Profile #
     def test_edit_profile(self):
         self.login(email="profile_john@example.com", password="yolo")
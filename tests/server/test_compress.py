@@ -0,0 +1,82 @@
+import unittest
+import zlib
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+from app.compress import GzipMiddleware
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class GzipMiddlewareTestCase(unittest.TestCase):
+    def client(self, response):
+        app = GzipMiddleware(response, min_size=100, level=6)
+        return Client(app, BaseResponse)
+
+    def get(self, response, encoding='gzip'):
+        headers = {'Accept-Encoding': encoding} if encoding else {}
+        return self.client(response).get('/', headers=headers)
+
+    def test_compresses_text_over_min_size(self):
+        body = 'record ' * 100
+        response = self.get(Response(body, mimetype='text/html'))
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(gunzip(response.data), body)
+
+    def test_streams_chunk_by_chunk(self):
+        chunks = ['a,b,c\n' * 50, 'd,e,f\n' * 50, 'g,h,i\n' * 50]
+        sent = []
+
+        def generate():
+            for chunk in chunks:
+                yield chunk
+
+        app = GzipMiddleware(Response(generate(), mimetype='text/csv'), min_size=100)
+        body = app({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                   lambda status, headers: sent.append(dict(headers)))
+        # Each chunk decompresses on arrival, without waiting for the rest
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for index, data in enumerate(body):
+            self.assertEqual(decompressor.decompress(data), chunks[index] if index < 3 else '')
+        self.assertEqual(sent[0]['Content-Encoding'], 'gzip')
+
+    def test_leaves_small_encoded_and_binary_responses_alone(self):
+        response = self.get(Response('tiny', mimetype='text/html'))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, 'tiny')
+
+        body = 'x' * 500
+        encoded = Response(body, mimetype='text/csv', headers={'Content-Encoding': 'identity'})
+        self.assertEqual(self.get(encoded).data, body)
+        self.assertEqual(self.get(Response(body, mimetype='image/png')).data, body)
+        self.assertEqual(self.get(Response(body, mimetype='text/html'), encoding=None).data, body)
+        self.assertEqual(self.get(Response(body, mimetype='text/html'), encoding='gzip;q=0').data, body)
+
+    def test_gzip_body_gets_its_own_etag(self):
+        body = 'record ' * 100
+
+        def app(environ, start_response):
+            response = Response(body, mimetype='text/html')
+            response.set_etag('v1')
+            return response.make_conditional(environ)(environ, start_response)
+
+        client = self.client(app)
+        gzipped = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['ETag'], '"v1-gzip"')
+        plain = client.get('/')
+        self.assertEqual(plain.headers['ETag'], '"v1"')
+
+        # Each tag revalidates its own representation
+        response = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"v1-gzip"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"v1-gzip"')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        response = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"v1"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"v1"')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        response = client.get('/', headers={'If-None-Match': '"v1"'})
+        self.assertEqual(response.status_code, 304)
@@ -0,0 +1,36 @@
+import unittest
+from app import create_app, db, mail
+from app.models import Role, OutboxMessage
+from app.outbox import drain
+
+
+class AccountMailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['RECORDBIN_MAIL_SENDER'] = 'bin@example.com'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_confirmation_goes_through_the_outbox(self):
+        client = self.app.test_client(use_cookies=True)
+        with mail.record_messages() as outbox:
+            client.post('/auth/register', data=dict(
+                email='john@example.com', username='john', password='catsdogs', password2='catsdogs'))
+            self.assertEqual(outbox, [])
+
+            message = OutboxMessage.query.one()
+            self.assertEqual((message.recipient, message.kind), ('john@example.com', 'confirm'))
+            self.assertIsNone(message.template)
+            self.assertEqual(drain(), 1)
+
+        self.assertEqual(outbox[0].subject, '[RecordBin] Confirm Your Account')
+        # Rendered in the request, so the link is complete
+        self.assertIn('http://localhost/auth/confirm/', outbox[0].body)
@@ -0,0 +1,84 @@
+import unittest
+import gzip
+import json
+import tarfile
+from StringIO import StringIO
+from app import create_app, db
+from app.models import User, Role, Size, Format, Title, Image, decode_id
+from app.imports import import_collection
+from tests.server.test_imports import CSV
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        Format.insert_formats()
+        Size.insert_sizes()
+        self.user = User(
+            email='john@example.com', username='john', password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_download_streams_csv(self):
+        import_collection(self.user, StringIO(CSV))
+        client = self.app.test_client(use_cookies=True)
+        client.post('/', data=dict(email='john@example.com', password='cat'))
+
+        response = client.get('/download/john')
+        self.assertTrue(response.is_streamed)
+        lines = response.data.splitlines()
+        self.assertEqual(lines[0], 'Artist,Title,Color,Year,Size,Date Added')
+        self.assertEqual(
+            [line.split(',')[1] for line in lines[1:]],
+            ['Squawk', 'Ace of Spades', 'Paranoid', 'Vol. 4'])
+        self.assertEqual(lines[2].split(',')[0], 'Mot\xc3\xb6rhead')
+
+        response = client.get('/download/john', headers={'Accept-Encoding': 'gzip'})
+        # Compressed by GzipMiddleware, like any other text response
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO(response.data)).read().splitlines(), lines)
+
+        # Round trip: the export imports back as nothing but duplicates
+        result = import_collection(User.query.get(self.user.id), StringIO('\n'.join(lines)))
+        self.assertEqual((result.added, result.duplicates), (0, 4))
+
+    def test_download_jsonl_and_archive(self):
+        import_collection(self.user, StringIO(CSV))
+        paranoid = Title.query.filter_by(name='Paranoid').first()
+        db.session.add(Image(record_id=paranoid.id, image_url='http://example.com/p.jpg'))
+        db.session.commit()
+        client = self.app.test_client(use_cookies=True)
+        client.post('/', data=dict(email='john@example.com', password='cat'))
+
+        response = client.get('/download/john?format=jsonl')
+        records = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0]['title'], 'Paranoid')
+        self.assertEqual(records[0]['image'], 'http://example.com/p.jpg')
+        self.assertEqual(int(decode_id(str(records[0]['id']))), paranoid.id)
+        self.assertEqual(records[-1]['artist'], u'Mot\xf6rhead')
+
+        response = client.get('/download/john?format=archive')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        archive = tarfile.open(fileobj=StringIO(response.data), mode='r:gz')
+        self.assertEqual(archive.getnames(), ['records.jsonl', 'images.tsv'])
+        self.assertEqual(
+            archive.extractfile('records.jsonl').read().splitlines()[0],
+            json.dumps(records[0], sort_keys=True))
+        self.assertEqual(
+            archive.extractfile('images.tsv').read(),
+            '{}\thttp://example.com/p.jpg\n'.format(records[0]['id']))
+
+        self.assertEqual(client.get('/download/john?format=xml').status_code, 400)
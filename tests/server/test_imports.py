@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+from StringIO import StringIO
+from app import create_app, db
+from app.models import User, Role, Size, Format, Title, Artist
+from app.imports import import_collection, CollectionImportError
+
+
+CSV = """Artist,Title,Color,Year,Size,Date Added
+Black Sabbath,Paranoid,Black,1970,12,09/18/70
+Black Sabbath,Vol. 4,Black,1972,12,
+Budgie,Squawk,Green,1972,7,
+Black Sabbath,Paranoid,black,1970,12,
+,No Artist,Red,1999,12,
+Budgie,Bad Year,Red,nineteen,12,
+Budgie,Bad Size,Red,1975,9,
+Motörhead,Ace of Spades,Black,1980,7,
+"""
+
+
+class ImportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        Format.insert_formats()
+        Size.insert_sizes()
+        self.user = User(
+            email='john@example.com', username='john', password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import_in_chunks(self):
+        seen = []
+        result = import_collection(
+            self.user, StringIO(CSV), chunk_size=2, progress=lambda r: seen.append(r.added))
+        self.assertEqual(result.rows, 8)
+        self.assertEqual(result.added, 4)
+        self.assertEqual(result.duplicates, 1)
+        self.assertEqual([line for line, message in result.errors], [6, 7, 8])
+        self.assertEqual(seen, [2, 3, 4])
+        self.assertEqual(Title.query.count(), 4)
+        self.assertEqual(Artist.query.count(), 3)
+        self.assertEqual(User.query.get(self.user.id).records_count, 4)
+        paranoid = Title.query.filter_by(name='Paranoid').first()
+        self.assertEqual(paranoid.timestamp.year, 1970)
+
+        # Importing the same file again only finds duplicates
+        result = import_collection(User.query.get(self.user.id), StringIO(CSV))
+        self.assertEqual(result.added, 0)
+        self.assertEqual(result.duplicates, 5)
+
+    def test_over_long_cells_are_reported_per_row(self):
+        csv = (
+            "Artist,Title,Color,Year,Size,Notes\n"
+            "Budgie,Squawk,{},1972,7,\n"
+            "Budgie,Squawk,Green,1972,7,{}\n"
+            "Budgie,Squawk,Green,99999999999,7,\n"
+            "Budgie,Squawk,Green,1972,7,fine\n").format('x' * 65, 'x' * 129)
+        result = import_collection(self.user, StringIO(csv))
+        self.assertEqual(result.added, 1)
+        self.assertEqual(result.errors, [
+            (2, 'Color has a 64 character limit'), (3, 'Notes has a 128 character limit'),
+            (4, 'Year is out of range')])
+
+    def test_large_chunks_are_inserted_and_indexed(self):
+        from app.search import matching_ids
+        rows = ''.join('Budgie,Take {},Green,1972,7\n'.format(number) for number in range(1200))
+        result = import_collection(
+            self.user, StringIO("Artist,Title,Color,Year,Size\n" + rows), chunk_size=1200)
+        self.assertEqual(result.added, 1200)
+        user = User.query.get(self.user.id)
+        self.assertEqual(user.records_count, 1200)
+        self.assertEqual(user.collection_version, 1)
+        self.assertEqual(len(db.session.execute(matching_ids(user, 'take 1199')).fetchall()), 1)
+        self.assertEqual(len(db.session.execute(matching_ids(user, 'budgie')).fetchall()), 1200)
+
+    def test_missing_columns(self):
+        with self.assertRaises(CollectionImportError):
+            import_collection(self.user, StringIO("Artist,Title\nBudgie,Squawk\n"))
+        self.assertEqual(Title.query.count(), 0)
+
+    def test_import_endpoint_streams_progress(self):
+        client = self.app.test_client(use_cookies=True)
+        client.post('/', data=dict(email='john@example.com', password='cat'))
+        response = client.post('/import/john', data=dict(csv_file=(StringIO(CSV), 'records.csv')))
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertTrue(lines[-1]['done'])
+        self.assertEqual(lines[-1]['added'], 4)
+        self.assertEqual(len(lines[-1]['errors']), 3)
+
+        response = client.post('/import/john', data=dict(
+            csv_file=(StringIO("Title\nSquawk\n"), 'records.csv')))
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,47 @@
+import unittest
+from datetime import datetime
+from app import create_app, db
+from app.models import Role, Size, Format
+from app.lookups import lookups
+
+
+class LookupsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        Format.insert_formats()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_inserts_refresh_the_registry(self):
+        self.assertEqual(lookups().sizes, [])
+        Size.insert_sizes()
+        self.assertEqual([size.name for size in lookups().sizes], [7, 10, 12])
+        self.assertEqual(lookups().formats[0].name, 'vinyl')
+        self.assertEqual(lookups().role('admin').name, 'admin')
+
+    def test_year_choices(self):
+        years = lookups().year_choices()
+        self.assertEqual(years[0], (datetime.utcnow().year, datetime.utcnow().year))
+        self.assertEqual(years[-1], (1950, 1950))
+        self.assertTrue(lookups().year_choices() is years)
+
+    def test_select_options_are_cached(self):
+        from app.main.forms import AddRecordForm
+        Size.insert_sizes()
+        with self.app.test_request_context():
+            form = AddRecordForm()
+            form.size.data = 2
+            html = form.size()
+            self.assertTrue('<option selected value="2">10</option>' in html)
+            self.assertTrue('<option value="1">7</option>' in html)
+            self.assertEqual(len(lookups()._options), 1)
+            form.size()
+            self.assertEqual(len(lookups()._options), 1)
@@ -0,0 +1,113 @@
+import unittest
+import threading
+import time
+import json
+from app import create_app, db
+from app.models import User, Role, Size, Format, Title, Artist
+from app.notifications import NotificationHub, hub
+
+
+class NotificationHubTestCase(unittest.TestCase):
+    def test_delivers_only_to_watchers(self):
+        h = NotificationHub()
+        watching = h.subscribe([1, 2])
+        other = h.subscribe([3])
+        h.publish(2, {'title_id': 7})
+        self.assertEqual(watching.get(0.1), {'title_id': 7})
+        self.assertTrue(other.get(0.01) is None)
+
+    def test_unsubscribe(self):
+        h = NotificationHub()
+        subscription = h.subscribe([1])
+        subscription.close()
+        h.publish(1, {'title_id': 7})
+        self.assertTrue(subscription.get(0.01) is None)
+
+    def test_full_queue_drops_events(self):
+        h = NotificationHub()
+        subscription = h.subscribe([1])
+        for i in range(200):
+            h.publish(1, {'title_id': i})
+        self.assertEqual(subscription.queue.qsize(), 100)
+        subscription.drain()
+        self.assertTrue(subscription.get(0.01) is None)
+
+
+class FeedStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.secret_key = "testing"
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['RECORDBIN_FEED_STREAMING'] = True
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        Format.insert_formats()
+        Size.insert_sizes()
+        Artist(name="Black Sabbath").add_to_table()
+        self.user = User(
+            email='john@example.com', username='john', password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+        self.user.follow(self.user)
+        self.client = self.app.test_client(use_cookies=True)
+        self.client.post('/', data=dict(email='john@example.com', password='cat'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_title(self, name):
+        Title(
+            name=name, artist_id=1, year=1970, format_id=1,
+            owner_id=self.user.id, mail=0, size_id=3).add_to_table()
+
+    def feed(self, url):
+        return json.loads(self.client.get(url).data)
+
+    def test_streaming_is_opt_in(self):
+        self.app.config['RECORDBIN_FEED_STREAMING'] = False
+        response = self.client.get('/john/follower_records/wait')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/john/follower_records/stream')
+        self.assertEqual(response.status_code, 404)
+
+    def test_wait_returns_newer_items_at_once(self):
+        self.add_title('Paranoid')
+        since = self.feed('/john/follower_records')[0]['cursor']
+        self.add_title('Vol. 4')
+        items = self.feed('/john/follower_records/wait?since=' + since)
+        self.assertEqual([item['title'] for item in items], ['Vol. 4'])
+
+    def test_wait_is_woken_by_publish(self):
+        self.app.config['RECORDBIN_FEED_WAIT_TIMEOUT'] = 5
+        self.add_title('Paranoid')
+        since = self.feed('/john/follower_records')[0]['cursor']
+        user_id = self.user.id
+        timer = threading.Timer(0.2, hub.publish, [user_id, {'title_id': 0}])
+        timer.start()
+        started = time.time()
+        items = self.feed('/john/follower_records/wait?since=' + since)
+        timer.join()
+        self.assertEqual(items, [])
+        self.assertTrue(time.time() - started < 2)
+
+    def test_stream_sends_feed_events(self):
+        self.app.config['RECORDBIN_FEED_STREAM_TIMEOUT'] = 1
+        self.app.config['RECORDBIN_FEED_KEEPALIVE'] = 0.1
+        self.add_title('Paranoid')
+        since = self.feed('/john/follower_records')[0]['cursor']
+        self.add_title('Vol. 4')
+
+        response = self.client.get(
+            '/john/follower_records/stream?since=' + since, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        event = next(chunks)
+        self.assertTrue(event.startswith('id: '))
+        self.assertTrue('event: feed' in event)
+        self.assertTrue('"Vol. 4"' in event)
+        self.assertEqual(next(chunks), ': keepalive\n\n')
+        response.close()
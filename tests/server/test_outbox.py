@@ -0,0 +1,145 @@
+import socket
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db, mail
+from app.models import User, Role, OutboxMessage
+from app import outbox as app_outbox
+from app.outbox import queue_email, drain, prune, _claim
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['RECORDBIN_MAIL_SENDER'] = 'bin@example.com'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def user(self, name):
+        user = User.query.filter_by(username=name).first()
+        if user is None:
+            user = User(email=name + '@example.com', username=name, password='cat',
+                        confirmed=True)
+            db.session.add(user)
+            db.session.commit()
+        return user
+
+    def follow(self, recipient, follower):
+        user, fan = self.user(recipient), self.user(follower)
+        queue_email(
+            recipient + '@example.com', 'followed_by', username=recipient, user_id=user.id,
+            follower=dict(id=fan.id, username=follower, url='http://localhost/' + follower))
+        fan.follow(user)
+
+    def after_window(self):
+        return datetime.utcnow() + timedelta(
+            seconds=self.app.config['RECORDBIN_OUTBOX_DIGEST_WINDOW'] + 1)
+
+    def test_follow_notifications_are_digested(self):
+        self.follow('john', 'ozzy')
+        self.follow('john', 'lemmy')
+        self.follow('john', 'ozzy')
+        self.follow('tony', 'ozzy')
+
+        with mail.record_messages() as outbox:
+            # Nothing is due inside the digest window
+            self.assertEqual(drain(), 0)
+            later = self.after_window()
+            self.assertEqual(drain(now=later), 2)
+            self.assertEqual(drain(now=later), 0)
+
+        john, tony = sorted(outbox, key=lambda msg: msg.recipients)
+        self.assertEqual(john.subject, '[RecordBin] 2 people are now following you')
+        self.assertIn('ozzy - http://localhost/ozzy', john.body)
+        self.assertIn('lemmy - http://localhost/lemmy', john.body)
+        self.assertEqual(tony.subject, '[RecordBin] ozzy is now following you')
+        self.assertEqual(OutboxMessage.query.filter_by(sent=None).count(), 0)
+
+    def test_undone_follows_are_not_notified(self):
+        self.follow('john', 'ozzy')
+        self.follow('john', 'lemmy')
+        self.follow('tony', 'ozzy')
+        ozzy = self.user('ozzy')
+        ozzy.unfollow(self.user('john'))
+        ozzy.unfollow(self.user('tony'))
+
+        with mail.record_messages() as outbox:
+            self.assertEqual(drain(now=self.after_window()), 1)
+        self.assertEqual(outbox[0].subject, '[RecordBin] lemmy is now following you')
+        self.assertEqual(OutboxMessage.query.count(), 1)
+
+    def test_claimed_messages_are_left_to_their_sender(self):
+        self.follow('john', 'ozzy')
+        self.follow('john', 'lemmy')
+        later = self.after_window()
+        # Another sender has just taken the batch
+        self.assertEqual(len(_claim('other', later, 1)), 2)
+
+        with mail.record_messages() as outbox:
+            self.assertEqual(drain(now=later), 0)
+            # ... and died; its lease runs out
+            expired = later + timedelta(seconds=self.app.config['RECORDBIN_OUTBOX_LEASE'])
+            self.assertEqual(drain(now=expired), 1)
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(OutboxMessage.query.filter_by(sent=None).count(), 0)
+
+    def test_claims_are_released_when_smtp_is_down(self):
+        self.follow('john', 'ozzy')
+        later = self.after_window()
+
+        def connect():
+            raise socket.error('connection refused')
+        app_outbox.mail.connect, real_connect = connect, app_outbox.mail.connect
+        try:
+            with self.assertRaises(socket.error):
+                drain(now=later)
+        finally:
+            app_outbox.mail.connect = real_connect
+
+        message = OutboxMessage.query.one()
+        self.assertIsNone(message.claimed_by)
+        self.assertEqual(message.send_after, later)
+        with mail.record_messages() as outbox:
+            self.assertEqual(drain(now=later), 1)
+
+    def test_prune_drops_old_sent_and_given_up_messages(self):
+        max_attempts = self.app.config['RECORDBIN_OUTBOX_MAX_ATTEMPTS']
+        old = datetime.utcnow() - timedelta(days=8)
+        for sent, attempts, created in [
+                (old, 0, old), (None, max_attempts, old), (None, max_attempts, datetime.utcnow()),
+                (None, 1, old), (datetime.utcnow(), 0, old)]:
+            message = queue_email('john@example.com', 'notice', 'Hi', 'auth/email/followed_by')
+            message.sent, message.attempts, message.created = sent, attempts, created
+        db.session.commit()
+        self.assertEqual(prune(7), 2)
+        self.assertEqual(OutboxMessage.query.count(), 3)
+
+    def test_undeliverable_messages_are_given_up(self):
+        self.app.config['RECORDBIN_MAIL_SENDER'] = None
+        queue_email('john@example.com', 'notice', 'Hello', 'auth/email/followed_by',
+                    username='john', followers=[])
+        db.session.commit()
+        self.assertEqual(drain(), 0)
+        message = OutboxMessage.query.one()
+        self.assertIsNone(message.sent)
+        self.assertEqual(message.attempts, self.app.config['RECORDBIN_OUTBOX_MAX_ATTEMPTS'])
+
+    def test_follow_view_queues_instead_of_sending(self):
+        for name in ('john', 'ozzy'):
+            db.session.add(User(email=name + '@example.com', username=name,
+                                password='cat', confirmed=True))
+        db.session.commit()
+        client = self.app.test_client(use_cookies=True)
+        client.post('/', data=dict(email='ozzy@example.com', password='cat'))
+        with mail.record_messages() as outbox:
+            client.get('/follow/john')
+        self.assertEqual(outbox, [])
+        message = OutboxMessage.query.one()
+        self.assertEqual((message.recipient, message.kind), ('john@example.com', 'followed_by'))
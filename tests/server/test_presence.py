@@ -0,0 +1,63 @@
+import unittest
+import time
+from app import create_app, db
+from app.models import User, Role
+
+
+class LastSeenBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.secret_key = "testing"
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.buffer = self.app.extensions['last_seen']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_user(self, username):
+        u = User(email=username + '@example.com', username=username,
+                 password='cat', confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        return u
+
+    def last_seen(self, user_id):
+        return db.session.query(User.last_seen).filter_by(id=user_id).scalar()
+
+    def test_touch_is_throttled_per_user(self):
+        now = time.time()
+        self.assertTrue(self.buffer.touch(1, now))
+        self.assertFalse(self.buffer.touch(1, now + 1))
+        self.assertTrue(self.buffer.touch(2, now + 1))
+        self.assertTrue(self.buffer.touch(1, now + self.buffer.window))
+
+    def test_flush_writes_all_pending_in_one_update(self):
+        u1 = self.add_user('john')
+        u2 = self.add_user('susan')
+        before = self.last_seen(u1.id)
+        later = time.time() + 3600
+        self.buffer.touch(u1.id, later)
+        self.buffer.touch(u2.id, later)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertTrue(self.last_seen(u1.id) > before)
+        self.assertEqual(self.last_seen(u1.id), self.last_seen(u2.id))
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_requests_do_not_write_until_due(self):
+        u = self.add_user('john')
+        client = self.app.test_client(use_cookies=True)
+        client.post('/', data=dict(email='john@example.com', password='cat'))
+        client.get('/users')
+        self.assertTrue(u.id in self.buffer._pending)
+        seen = self.last_seen(u.id)
+
+        self.buffer._last_flush = time.time() - self.buffer.window
+        client.get('/users')
+        self.assertFalse(self.buffer._pending)
+        self.assertTrue(self.last_seen(u.id) >= seen)
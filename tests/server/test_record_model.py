@@ -1,6 +1,13 @@
+import os
 import unittest
 from app import create_app, db
-from app.models import Title, Size, Format, Artist, Role
+from app.models import (
+    Title, Size, Format, Artist, Role, User, Image, group_records,
+    record_cursor, parse_cursor)
+
+
+# Tests of PostgreSQL-only paths run against this database when it is set
+POSTGRES_URL = os.environ.get('RECORDBIN_TEST_POSTGRES_URL')
 
 
 def _artist():
@@ -61,6 +68,31 @@ class UserModelTestCase(unittest.TestCase):
         a = _artist()
         self.assertTrue(Artist.query.filter_by(name=a.name).first() is None)
 
+    def test_resolve_artist(self):
+        _artist().add_to_table()
+        self.assertEqual(Artist.resolve("Black Sabbath"), 1)
+        thin_lizzy = Artist.resolve("Thin Lizzy")
+        db.session.commit()
+        self.assertEqual(Artist.query.filter_by(name="Thin Lizzy").first().id, thin_lizzy)
+        self.assertEqual(Artist.resolve("Thin Lizzy"), thin_lizzy)
+        self.assertEqual(Artist.query.count(), 2)
+
+    def test_resolve_artist_rolled_back_is_not_cached(self):
+        Artist.resolve("Thin Lizzy")
+        db.session.rollback()
+        self.assertEqual(Artist.query.count(), 0)
+        Artist.resolve("Thin Lizzy")
+        db.session.commit()
+        self.assertEqual(Artist.query.count(), 1)
+
+    def test_resolve_many_artists(self):
+        _artist().add_to_table()
+        ids = Artist.resolve_many(["Black Sabbath", "Thin Lizzy", "Budgie", "Thin Lizzy"])
+        db.session.commit()
+        self.assertEqual(sorted(ids), ["Black Sabbath", "Budgie", "Thin Lizzy"])
+        self.assertEqual(
+            dict((a.name, a.id) for a in Artist.query.all()), ids)
+
     def test_format_create(self):
         a = Format(name='vinyl')
         db.session.add(a)
@@ -132,6 +164,28 @@ class UserModelTestCase(unittest.TestCase):
         d.delete_from_table()
         self.assertTrue(len(Title.query.all()) == 0)
 
+    def test_title_content_key(self):
+        from sqlalchemy.exc import IntegrityError
+        _artist().add_to_table()
+        t = _title()
+        t.add_to_table(image_url='http://example.com/cover.jpg')
+        self.assertEqual(Image.query.filter_by(record_id=t.id).count(), 1)
+
+        duplicate = _title()
+        duplicate.name = "  master OF   reality"
+        with self.assertRaises(IntegrityError):
+            duplicate.add_to_table()
+        db.session.rollback()
+
+        t.notes = "ipsum"
+        db.session.commit()
+        _title().add_to_table()
+        self.assertEqual(Title.query.count(), 2)
+
+        db.session.execute(Title.__table__.update().values(content_key=None))
+        self.assertEqual(Title.rebuild_content_keys(), [])
+        self.assertEqual(Title.query.filter(Title.content_key == None).count(), 0)
+
     def test_title_timestamp(self):
         import datetime
         t = _title()
@@ -140,3 +194,172 @@ class UserModelTestCase(unittest.TestCase):
             (t.timestamp.year, t.timestamp.month, t.timestamp.day) ==
             (datetime.datetime.now().year, datetime.datetime.now().month,
              datetime.datetime.now().day))
+
+    def test_group_records(self):
+        Size.insert_sizes()
+        Format.insert_formats()
+        Artist(name="Black Sabbath").add_to_table()
+        Artist(name="AC/DC").add_to_table()
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        for artist_id, size_id, mail in [(1, 3, 0), (2, 3, 0), (1, 1, 1)]:
+            Title(
+                name="Paranoid", artist_id=artist_id, year=1970, format_id=1,
+                owner_id=u.id, mail=mail, size_id=size_id).add_to_table()
+
+        groups = group_records(
+            u.owned_records(), Size.query.order_by(Size.id).all(),
+            Format.query.order_by(Format.id).all())
+        self.assertEqual(
+            [g.id for g in groups],
+            ['seven_inches', 'ten_inches', 'twelve_inches',
+             'seven_inches_mail', 'ten_inches_mail', 'twelve_inches_mail'])
+        twelve = groups[2].records
+        self.assertEqual([r[1] for r in twelve], ["AC/DC", "Black Sabbath"])
+        self.assertEqual(len(groups[3].records), 1)
+        self.assertEqual(sum(len(g.records) for g in groups), 3)
+
+    def test_records_page_images_scoped_to_owner(self):
+        Size.insert_sizes()
+        Format.insert_formats()
+        _artist().add_to_table()
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        mine = _title()
+        mine.owner_id = u1.id
+        mine.add_to_table()
+        theirs = _title()
+        theirs.owner_id = u2.id
+        theirs.add_to_table()
+        Image(record_id=mine.id, image_url='http://example.com/a.jpg').add_to_table()
+        Image(record_id=theirs.id, image_url='http://example.com/b.jpg').add_to_table()
+
+        self.assertEqual(
+            [(row[0].id, row[-1]) for row in u1.records_page()],
+            [(mine.id, 'http://example.com/a.jpg')])
+        self.assertEqual(
+            [(row[0].id, row[-1]) for row in u2.records_page()],
+            [(theirs.id, 'http://example.com/b.jpg')])
+
+    def test_records_page_keyset(self):
+        Size.insert_sizes()
+        Format.insert_formats()
+        for name in ("Black Sabbath", "ac/dc", "Thin Lizzy"):
+            Artist(name=name).add_to_table()
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        for artist_id in (1, 2, 3):
+            for year in (1972, 1970):
+                Title(
+                    name="Side", artist_id=artist_id, year=year, format_id=1,
+                    owner_id=u.id, mail=0, size_id=3).add_to_table()
+
+        seen = []
+        after = None
+        while True:
+            page = u.records_page(after=after, limit=4)
+            seen.extend((r[1], r[0].year) for r in page)
+            if len(page) < 4:
+                break
+            after = parse_cursor(record_cursor(page[-1]))
+        self.assertEqual(seen, [
+            ("ac/dc", 1970), ("ac/dc", 1972),
+            ("Black Sabbath", 1970), ("Black Sabbath", 1972),
+            ("Thin Lizzy", 1970), ("Thin Lizzy", 1972)])
+        self.assertEqual(u.records_page(size_id=1), [])
+        self.assertEqual(u.record_group_counts(), {(12, 'vinyl', 0): 6})
+        self.assertTrue(parse_cursor('not a cursor') is None)
+
+    def test_search_index_tracks_title_writes(self):
+        from app.search import matching_ids
+        Artist(name="Black Sabbath").add_to_table()
+        u = User(email='john@example.com', password='cat')
+        other = User(email='susan@example.org', password='dog')
+        db.session.add_all([u, other])
+        db.session.commit()
+        t = _title()
+        t.owner_id = u.id
+        t.add_to_table()
+        theirs = _title()
+        theirs.owner_id = other.id
+        theirs.add_to_table()
+
+        def found(query):
+            return [row[0] for row in db.session.execute(matching_ids(u, query))]
+
+        self.assertEqual(found('sabb'), [t.id])
+        self.assertEqual(found('master 1970'), [t.id])
+        self.assertEqual(found('sabbath paranoid'), [])
+
+        t.name = "Paranoid"
+        db.session.commit()
+        self.assertEqual(found('paranoid'), [t.id])
+        self.assertEqual(found('master'), [])
+
+        t.delete_from_table()
+        self.assertEqual(found('sabbath'), [])
+
+    def test_search_rebuild_index(self):
+        from app.search import matching_ids, rebuild_index
+        Artist(name="Black Sabbath").add_to_table()
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        t = _title()
+        t.owner_id = u.id
+        t.add_to_table()
+        db.session.execute("DELETE FROM title_search")
+        db.session.commit()
+        rebuild_index()
+        self.assertEqual(
+            [row[0] for row in db.session.execute(matching_ids(u, 'lorem'))], [t.id])
+
+    def test_public_ids(self):
+        from app.models import encode_id, decode_id, encode_ids, decode_ids
+        ids = [1, 2, 3, 1000, 2 ** 31 - 1]
+        encoded = encode_ids(ids)
+        self.assertEqual(len(set(encoded)), len(ids))
+        self.assertTrue(all(len(e) == 16 for e in encoded))
+        self.assertEqual(decode_ids(encoded), ids)
+        self.assertEqual(decode_id(encode_id(42)), 42)
+        self.assertEqual(decode_ids(['nothex', '', None, '-' * 16]), [None] * 4)
+        # Well-formed, but outside the primary key range
+        self.assertEqual(decode_ids(encode_ids([0, 2 ** 31, 2 ** 63 + 5])), [None] * 3)
+
+        self.app.config['SECRET_KEY'] = 'another key'
+        self.assertNotEqual(encode_ids(ids), encoded)
+
+
+@unittest.skipUnless(POSTGRES_URL, 'RECORDBIN_TEST_POSTGRES_URL is not set')
+class PostgresArtistTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = POSTGRES_URL
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_resolve_many_inserts_only_missing_artists(self):
+        _artist().add_to_table()
+        existing = Artist.query.filter_by(name="Black Sabbath").one().id
+        ids = Artist.resolve_many(["Black Sabbath", "Thin Lizzy", "Budgie"])
+        self.assertEqual(ids["Black Sabbath"], existing)
+        self.assertEqual(db.session.info['new_artists'], dict(
+            (name, ids[name]) for name in ("Thin Lizzy", "Budgie")))
+        db.session.commit()
+        self.assertEqual(dict((a.name, a.id) for a in Artist.query.all()), ids)
+
+        # All cached now; a fresh cache finds them without inserting
+        from app.models import artist_cache
+        artist_cache(self.app).clear()
+        self.assertEqual(Artist.resolve_many(list(ids)), ids)
+        self.assertFalse(db.session.info.get('new_artists'))
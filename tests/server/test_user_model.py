@@ -1,7 +1,7 @@
 import unittest
 import time
 from app import create_app, db
-from app.models import User, AnonymousUser, Role, Permission, Follow
+from app.models import User, AnonymousUser, Role, Permission, Follow, Title, FeedItem
 from datetime import datetime
 
 
@@ -188,3 +188,163 @@ class UserModelTestCase(unittest.TestCase):
         db.session.delete(u2)
         db.session.commit()
         self.assertTrue(Follow.query.count() == 0)
+
+    def test_record_counts(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        for name in ('Paranoid', 'Vol. 4'):
+            Title(
+                name=name, artist_id=1, year=1970, format_id=1,
+                owner_id=u1.id, mail=0, size_id=3).add_to_table()
+        counts = User.record_counts()
+        self.assertEqual(counts.get(u1.id), 2)
+        self.assertEqual(counts.get(u2.id, 0), 0)
+        self.assertEqual(User.record_count(u1), 2)
+
+    def test_counters_follow_writes(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        u1.follow(u2)
+        self.assertEqual((u1.followed_count, u1.followers_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.followers_count), (0, 1))
+        t = Title(
+            name='Paranoid', artist_id=1, year=1970, format_id=1,
+            owner_id=u2.id, mail=0, size_id=3)
+        t.add_to_table()
+        self.assertEqual(u2.records_count, 1)
+        t.delete_from_table()
+        self.assertEqual(u2.records_count, 0)
+        u1.unfollow(u2)
+        self.assertEqual(u1.followed_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(User.check_counters(), [])
+
+    def test_rebuild_counters(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        u.follow(u)
+        User.query.update({User.followers_count: 5, User.records_count: 3})
+        db.session.commit()
+        self.assertEqual(
+            sorted(User.check_counters()),
+            [(None, 'followers_count', 5, 1), (None, 'records_count', 3, 0)])
+        User.rebuild_counters()
+        self.assertEqual(User.check_counters(), [])
+        self.assertEqual(
+            (u.records_count, u.followers_count, u.followed_count), (0, 1, 1))
+
+    def _feed_users(self):
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='susan@example.org', username='susan', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        return u1, u2
+
+    def _add_title(self, owner, name):
+        t = Title(
+            name=name, artist_id=1, year=1970, format_id=1,
+            owner_id=owner.id, mail=0, size_id=3)
+        t.add_to_table()
+        return t
+
+    def test_feed_fan_out_on_write(self):
+        from app.models import Artist
+        Artist(name='Black Sabbath').add_to_table()
+        u1, u2 = self._feed_users()
+        old = self._add_title(u2, 'Paranoid')
+        u1.follow(u2)
+        new = self._add_title(u2, 'Vol. 4')
+        self.assertEqual(
+            [r[0].id for r in u1.follower_records().all()], [new.id, old.id])
+        self.assertEqual(FeedItem.query.filter_by(user_id=u2.id).count(), 0)
+
+        new.delete_from_table()
+        self.assertEqual([r[0].id for r in u1.follower_records().all()], [old.id])
+
+        u1.unfollow(u2)
+        self.assertEqual(u1.follower_records().all(), [])
+
+    def test_feed_rebuild(self):
+        from app.models import Artist
+        Artist(name='Black Sabbath').add_to_table()
+        u1, u2 = self._feed_users()
+        u1.follow(u2)
+        for name in ('Paranoid', 'Vol. 4', 'Sabotage'):
+            self._add_title(u2, name)
+        FeedItem.query.delete()
+        db.session.commit()
+        FeedItem.rebuild(2)
+        self.assertEqual(
+            [r[0].name for r in u1.follower_records().all()], ['Sabotage', 'Vol. 4'])
+
+    def test_load_user_is_cached_until_changed(self):
+        from sqlalchemy import event
+        from app.models import load_user
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        uid = u.id
+        db.session.remove()
+        load_user(uid).can(Permission.USE)
+        db.session.remove()
+
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            cached = load_user(uid)
+            self.assertEqual(cached.username, 'john')
+            self.assertTrue(cached.can(Permission.USE))
+            self.assertEqual(statements, [])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        cached.confirmed = True
+        db.session.commit()
+        db.session.remove()
+        self.assertTrue(load_user(uid).confirmed)
+
+    def test_load_user_sees_bumped_counters(self):
+        from app.models import load_user
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        uid = u.id
+        db.session.remove()
+        self.assertEqual(load_user(uid).followers_count, 0)
+        db.session.remove()
+
+        # A bulk UPDATE skips mapper events, so the cached row must be dropped by hand
+        User.bump_counter(uid, User.followers_count, 3)
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(uid).followers_count, 3)
+
+    def test_permissions_cache_follows_role_edits(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertFalse(u.can(Permission.ADMINISTER))
+        role = Role.query.filter_by(name='user').first()
+        role.permissions = Permission.USE | Permission.ADMINISTER
+        db.session.commit()
+        self.assertTrue(User.query.get(u.id).can(Permission.ADMINISTER))
+
+    def test_avatar_urls(self):
+        from app.models import avatar_url, email_hash
+        u = User(email='john@example.com', password='cat')
+        self.assertEqual(u.avatar_hash, email_hash('john@example.com'))
+        with self.app.test_request_context('/'):
+            url = u.gravatar(size=50)
+            self.assertEqual(
+                url, 'http://www.gravatar.com/avatar/{}?s=50&d=identicon&r=g'.format(u.avatar_hash))
+            self.assertTrue(avatar_url(u.avatar_hash, size=50) is url)
+        with self.app.test_request_context('/', base_url='https://localhost'):
+            self.assertTrue(u.gravatar(size=50).startswith('https://secure.gravatar.com/'))